@@ -17,6 +17,7 @@ setup(
     package_data = {
         'taggit': [
             'locale/*/LC_MESSAGES/*',
+            'templates/admin/taggit/tag/*',
         ],
     },
     license='BSD',
@@ -1,21 +1,191 @@
 from __future__ import unicode_literals
 
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import InvalidPage, Paginator
+from django.core.urlresolvers import reverse
+from django.template.response import TemplateResponse
+from django.utils.translation import ugettext_lazy as _, ungettext
 
-from taggit.models import Tag, TaggedItem
+try:
+    from django.contrib.admin.utils import unquote
+except ImportError:  # django < 1.7
+    from django.contrib.admin.util import unquote
+
+from taggit.counts import with_total_counts
+from taggit.managers import _model_name
+from taggit.models import GenericTaggedItemBase, Tag, TaggedItem, get_through_models
 
 
 class TaggedItemInline(admin.StackedInline):
     model = TaggedItem
 
 class TagAdmin(admin.ModelAdmin):
-    inlines = [
-        TaggedItemInline
-    ]
-    list_display = ["name", "slug"]
+    """
+    The change page lists the tagged objects read-only, a page at a time and
+    loaded with one query per content type, instead of an inline form per
+    tagged item. The changelist shows how many times each tag is used.
+    """
+    list_display = ["name", "slug", "num_times"]
     ordering = ["name", "slug"]
-    search_fields = ["name"]
+    # Matches names by prefix, like the autocompletion. Being case
+    # insensitive (UPPER(name) LIKE ...), it can't use the index of the name.
+    search_fields = ["^name"]
     prepopulated_fields = {"slug": ["name"]}
+    actions = ["merge_tags", "purge_tags"]
+    change_form_template = "admin/taggit/tag/change_form.html"
+    purge_confirmation_template = "admin/taggit/tag/purge_confirmation.html"
+    tagged_items_per_page = 50
+
+    def get_queryset(self, request):
+        parent = super(TagAdmin, self)
+        if hasattr(parent, 'get_queryset'):
+            qs = parent.get_queryset(request)
+        else:  # django < 1.6
+            qs = parent.queryset(request)
+        return with_total_counts(qs)
+    queryset = get_queryset
+
+    def get_actions(self, request):
+        actions = super(TagAdmin, self).get_actions(request)
+        if self.has_delete_permission(request):
+            # Deleting tags one by one through the collector doesn't scale,
+            # ``purge_tags`` replaces it.
+            actions.pop('delete_selected', None)
+        else:
+            # Both delete tags.
+            actions.pop('merge_tags', None)
+            actions.pop('purge_tags', None)
+        return actions
+
+    def num_times(self, tag):
+        return tag.num_times
+    num_times.short_description = _("Usage count")
+    num_times.admin_order_field = "num_times"
+
+    def merge_tags(self, request, queryset):
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        tags = sorted(queryset, key=lambda tag: (-tag.num_times, tag.pk))
+        if len(tags) < 2:
+            self.message_user(request, _("Select at least two tags to merge."),
+                              messages.WARNING)
+            return
+        self.model._default_manager.merge(tags[0], *tags[1:])
+        self.message_user(request, ungettext(
+            "Merged %(count)d tag into \"%(tag)s\".",
+            "Merged %(count)d tags into \"%(tag)s\".",
+            len(tags) - 1) % {'count': len(tags) - 1, 'tag': tags[0]})
+    merge_tags.short_description = _("Merge selected tags into the most used one")
+
+    def purge_tags(self, request, queryset):
+        """
+        Asks for a confirmation showing how many tagged items would be
+        deleted, like the ``delete_selected`` action, then purges the tags.
+        """
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        tags = list(queryset)
+        if not request.POST.get('post'):
+            return self.purge_confirmation(request, tags)
+        items = self.model._default_manager.purge(*tags)
+        self.message_user(request, ungettext(
+            "Deleted %(count)d tag and %(items)d tagged items.",
+            "Deleted %(count)d tags and %(items)d tagged items.",
+            len(tags)) % {'count': len(tags), 'items': items})
+    purge_tags.short_description = _("Delete selected tags and their tagged items")
+
+    def purge_confirmation(self, request, tags):
+        pks = [tag.pk for tag in tags]
+        tagged_items = []
+        for through in get_through_models(self.model):
+            count = through._default_manager.filter(tag__in=pks).count()
+            if count:
+                tagged_items.append((through._meta.verbose_name_plural, count))
+        context = {
+            'title': _("Are you sure?"),
+            'opts': self.model._meta,
+            'tags': tags,
+            'tagged_items': tagged_items,
+            'tagged_items_count': sum(count for name, count in tagged_items),
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        }
+        if hasattr(self.admin_site, 'each_context'):  # django >= 1.7
+            context.update(self.admin_site.each_context())
+        return TemplateResponse(request, self.purge_confirmation_template,
+                                context, current_app=self.admin_site.name)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        tag = self.get_object(request, unquote(object_id))
+        if tag is not None:
+            extra_context = dict(extra_context or {},
+                                 tagged_items=self.get_tagged_items(request, tag))
+        return super(TagAdmin, self).change_view(request, object_id, form_url,
+                                                 extra_context)
+
+    def get_tagged_items(self, request, tag):
+        """
+        Returns a section per through model using ``tag``: a dict with the
+        ``title``, the ``page`` of through rows, the page query parameter
+        ``param`` and the ``items`` on the page, ``(object, verbose name,
+        admin url)`` tuples.
+        """
+        sections = []
+        for through in get_through_models(self.model):
+            rows = through._default_manager.filter(tag=tag).order_by('pk')
+            if issubclass(through, GenericTaggedItemBase):
+                rows = rows.values_list('content_type', 'object_id')
+            else:
+                rows = rows.values_list('content_object', flat=True)
+            paginator = Paginator(rows, self.tagged_items_per_page)
+            if not paginator.count:
+                continue
+            param = '%s-p' % _model_name(through)
+            try:
+                page = paginator.page(request.GET.get(param, 1))
+            except InvalidPage:
+                page = paginator.page(1)
+            keys = list(page.object_list)
+            if not issubclass(through, GenericTaggedItemBase):
+                model = through._meta.get_field('content_object').rel.to
+                ct = ContentType.objects.get_for_model(model).pk
+                keys = [(ct, pk) for pk in keys]
+            sections.append({
+                'title': through._meta.verbose_name_plural,
+                'page': page,
+                'param': param,
+                'items': self._hydrate(keys),
+            })
+        return sections
+
+    def _hydrate(self, keys):
+        by_content_type = {}
+        for ct, pk in keys:
+            by_content_type.setdefault(ct, []).append(pk)
+        objects = {}
+        for ct, pks in by_content_type.items():
+            model = ContentType.objects.get_for_id(ct).model_class()
+            if model is None:
+                continue
+            for pk, obj in model._default_manager.in_bulk(pks).items():
+                objects[(ct, pk)] = obj
+        items = []
+        for key in keys:
+            obj = objects.get(key)
+            if obj is not None:
+                items.append((obj, obj._meta.verbose_name,
+                              self._admin_url(obj)))
+        return items
+
+    def _admin_url(self, obj):
+        model = type(obj)
+        if model not in self.admin_site._registry:
+            return None
+        return reverse('admin:%s_%s_change' % (model._meta.app_label,
+                                               _model_name(model)),
+                       args=(obj.pk,), current_app=self.admin_site.name)
 
 
 admin.site.register(Tag, TagAdmin)
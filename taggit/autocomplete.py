@@ -0,0 +1,259 @@
+"""
+Tag name autocompletion.
+
+Names are matched by prefix with a range query on the unique index of the
+name, ``name >= prefix AND name < bound`` where ``bound`` is the prefix with
+its last character incremented, which unlike ``LIKE 'prefix%'`` alone can use
+a plain B-tree index on every database. The ``LIKE`` is kept as well, for
+collations that don't sort by code point. Matches are ranked by usage count
+(see ``taggit.counts``) if the tag model has counts, by name otherwise.
+
+If the ``TAGGIT_AUTOCOMPLETE_INDEX`` setting is ``True`` the names are looked
+up in a ``TagNameIndex`` kept in the memory of each process instead.
+"""
+from __future__ import unicode_literals
+
+import bisect
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.utils import six
+from django.utils.six.moves import xrange
+
+from taggit.counts import counts_enabled, total_counts, with_counts
+
+
+def index_enabled():
+    return getattr(settings, 'TAGGIT_AUTOCOMPLETE_INDEX', False)
+
+
+def upper_bound(prefix):
+    """
+    Returns a string sorting after every string starting with ``prefix``, in
+    code point order, or ``None`` if there is none.
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        # Halves of surrogate pairs (on narrow builds) can't be incremented
+        # into a valid string, they are dropped with the largest character.
+        if last < sys.maxunicode and not 0xd800 <= last <= 0xdfff:
+            return prefix[:-1] + six.unichr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+def autocomplete(tag_model, prefix, limit=10):
+    """
+    Returns up to ``limit`` tags of ``tag_model`` whose name starts with
+    ``prefix``, most used first. The tags are annotated with ``num_times`` if
+    the counts are enabled.
+    """
+    if not prefix or limit <= 0:
+        return []
+    if index_enabled():
+        return get_index(tag_model).complete(prefix, limit)
+    qs = tag_model._default_manager.filter(name__gte=prefix,
+                                           name__startswith=prefix)
+    bound = upper_bound(prefix)
+    if bound is not None:
+        qs = qs.filter(name__lt=bound)
+    if counts_enabled(tag_model):
+        qs = with_counts(qs).order_by('-num_times', 'name')
+    else:
+        qs = qs.order_by('name')
+    return list(qs[:limit])
+
+
+class TagNameIndex(object):
+    """
+    The names of all the tags of ``tag_model`` in a sorted array, with their
+    slugs and usage counts, to complete prefixes without a query.
+
+    The index is loaded on first use and kept up to date incrementally: tags
+    saved or deleted in this process and count changes made by the tag
+    managers are applied immediately, and tags created by other processes are
+    read every ``refresh_interval`` seconds by selecting the primary keys
+    above the highest one seen. Renames, deletions and count changes made by
+    other processes are picked up by a full reload every ``reload_interval``
+    seconds.
+    """
+    refresh_interval = 60
+    reload_interval = 3600
+    # Rankings of prefixes matching more names than this are memoized until
+    # the next change.
+    memoize_threshold = 1000
+
+    def __init__(self, tag_model):
+        self.tag_model = tag_model
+        self._lock = threading.RLock()
+        self._loaded_at = None
+
+    def load(self):
+        tags = self._read(self.tag_model._default_manager.all())
+        with self._lock:
+            self._names = sorted(tags)
+            self._tags = tags
+            self._names_by_pk = dict((tag[0], name) for name, tag in tags.items())
+            self._max_pk = max(self._names_by_pk) if tags else None
+            self._memo = {}
+            self._loaded_at = self._refreshed_at = time.time()
+
+    def refresh(self):
+        """
+        Adds the tags created since the last load or refresh.
+        """
+        qs = self.tag_model._default_manager.all()
+        if self._max_pk is not None:
+            qs = qs.filter(pk__gt=self._max_pk)
+        tags = self._read(qs)
+        with self._lock:
+            for name, (pk, slug, count) in tags.items():
+                self._add(pk, name, slug, count)
+            self._refreshed_at = time.time()
+
+    def complete(self, prefix, limit=10):
+        self._ensure_fresh()
+        with self._lock:
+            names = self._memo.get((prefix, limit))
+            if names is None:
+                names = self._complete(prefix, limit)
+            return [self._tag(name) for name in names]
+
+    def _complete(self, prefix, limit):
+        start = bisect.bisect_left(self._names, prefix)
+        bound = upper_bound(prefix)
+        if bound is None:
+            stop = len(self._names)
+        else:
+            stop = bisect.bisect_left(self._names, bound, start)
+        # The bound is looser than the prefix if characters were dropped.
+        matches = (self._names[i] for i in xrange(start, stop)
+                   if self._names[i].startswith(prefix))
+        if not counts_enabled(self.tag_model):
+            return list(itertools.islice(matches, limit))
+        tags = self._tags
+        names = heapq.nsmallest(limit, matches,
+                                key=lambda name: (-tags[name][2], name))
+        if stop - start > self.memoize_threshold:
+            self._memo[(prefix, limit)] = names
+        return names
+
+    def update(self, tag):
+        with self._lock:
+            self._add(tag.pk, tag.name, tag.slug, self.remove(tag))
+
+    def remove(self, tag):
+        """
+        Removes ``tag`` and returns its count.
+        """
+        with self._lock:
+            name = self._names_by_pk.pop(tag.pk, None)
+            if name is None:
+                return 0
+            del self._names[bisect.bisect_left(self._names, name)]
+            self._memo = {}
+            return self._tags.pop(name)[2]
+
+    def update_counts(self, deltas):
+        with self._lock:
+            for pk, delta in deltas.items():
+                name = self._names_by_pk.get(pk)
+                if name is not None:
+                    pk, slug, count = self._tags[name]
+                    self._tags[name] = (pk, slug, count + delta)
+            self._memo = {}
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def _ensure_fresh(self):
+        now = time.time()
+        if not self.loaded or now - self._loaded_at > self.reload_interval:
+            self.load()
+        elif now - self._refreshed_at > self.refresh_interval:
+            self.refresh()
+
+    def _read(self, qs):
+        counts = total_counts(self.tag_model, qs)
+        return dict(
+            (name, (pk, slug, counts.get(pk) or 0))
+            for pk, name, slug in qs.values_list('pk', 'name', 'slug').iterator()
+        )
+
+    def _add(self, pk, name, slug, count):
+        if name not in self._tags:
+            bisect.insort(self._names, name)
+        self._tags[name] = (pk, slug, count)
+        self._names_by_pk[pk] = name
+        self._memo = {}
+        if self._max_pk is None or pk > self._max_pk:
+            self._max_pk = pk
+
+    def _tag(self, name):
+        pk, slug, count = self._tags[name]
+        tag = self.tag_model(pk=pk, name=name, slug=slug)
+        if counts_enabled(self.tag_model):
+            tag.num_times = count
+        return tag
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(tag_model):
+    """
+    Returns the ``TagNameIndex`` of ``tag_model`` in this process.
+    """
+    model = tag_model._meta.concrete_model
+    with _indexes_lock:
+        if model not in _indexes:
+            _indexes[model] = TagNameIndex(model)
+            post_save.connect(_tag_saved, sender=model)
+            post_delete.connect(_tag_deleted, sender=model)
+        return _indexes[model]
+
+
+def _loaded_index(tag_model):
+    index = _indexes.get(tag_model._meta.concrete_model)
+    if index is not None and index.loaded:
+        return index
+
+
+def update_index_tags(tag_model, tags):
+    """
+    Adds ``tags``, created in bulk without signals, to the index of
+    ``tag_model`` if it has one.
+    """
+    index = _loaded_index(tag_model)
+    if index is not None:
+        for tag in tags:
+            index.update(tag)
+
+
+def update_index_counts(tag_model, deltas):
+    """
+    Applies ``deltas``, a dict mapping tag primary keys to count changes, to
+    the index of ``tag_model`` if it has one.
+    """
+    index = _loaded_index(tag_model)
+    if index is not None:
+        index.update_counts(deltas)
+
+
+def _tag_saved(sender, instance, **kwargs):
+    index = _loaded_index(sender)
+    if index is not None:
+        index.update(instance)
+
+
+def _tag_deleted(sender, instance, **kwargs):
+    index = _loaded_index(sender)
+    if index is not None:
+        index.remove(instance)
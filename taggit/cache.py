@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.conf import settings
+
+
+class TagCache(object):
+    """
+    A process-local LRU cache mapping tag names and slugs to the primary
+    keys of the tags.
+
+    The size is taken from the ``TAGGIT_TAG_CACHE_SIZE`` setting unless given
+    explicitly, a size of ``0`` (the default) disables the cache. Entries are
+    dropped whenever a tag is saved or deleted.
+    """
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._lock = threading.RLock()
+        self.clear()
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'TAGGIT_TAG_CACHE_SIZE', 0)
+
+    @property
+    def enabled(self):
+        return bool(self.max_size)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._keys_by_pk = {}
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, model, field, value):
+        """
+        Returns the primary key of the ``model`` tag whose ``field`` (either
+        ``"name"`` or ``"slug"``) is ``value``, or ``None``.
+        """
+        key = (_model_key(model), field, value)
+        with self._lock:
+            try:
+                pk = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert the key to mark it as most recently used.
+            self._entries[key] = pk
+            self.hits += 1
+            return pk
+
+    def add(self, tag):
+        if not self.enabled:
+            return
+        model = _model_key(type(tag))
+        with self._lock:
+            for field in ('name', 'slug'):
+                key = (model, field, getattr(tag, field))
+                self._discard(key)
+                self._entries[key] = tag.pk
+                self._keys_by_pk.setdefault((model, tag.pk), set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, tag):
+        model = _model_key(type(tag))
+        with self._lock:
+            for key in self._keys_by_pk.pop((model, tag.pk), ()):
+                self._discard(key)
+
+    def _discard(self, key):
+        pk = self._entries.pop(key, None)
+        if pk is not None:
+            keys = self._keys_by_pk.get((key[0], pk))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_pk[(key[0], pk)]
+
+
+def _model_key(model):
+    # Proxies share the table (and thus the primary keys) of their concrete
+    # model.
+    opts = model._meta.concrete_model._meta
+    return (opts.app_label, opts.object_name)
+
+
+tag_cache = TagCache()
+
+
+def invalidate_tag(sender, instance, **kwargs):
+    tag_cache.invalidate(instance)
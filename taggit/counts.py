@@ -0,0 +1,242 @@
+"""
+Denormalized tag usage counts.
+
+Two kinds of counts are maintained by the write methods of the tag managers:
+
+* the ``usage_count`` field of tag models which have one, the number of times
+  the tag is used on any object;
+* if the ``TAGGIT_USAGE_COUNTS`` setting is ``True``, the ``TagCount`` table,
+  the number of times a tag is used per model. ``TAGGIT_USAGE_COUNT_SHARDS``
+  (1 by default) spreads the count of a tag over several rows.
+
+Deleting a tagged object removes its tags through its tag manager before the
+cascade. Through rows deleted without the tag managers (e.g. with
+``QuerySet.delete()`` on a through model) aren't counted, the
+``taggit_rebuild_counts`` command recomputes all counts.
+"""
+from __future__ import unicode_literals
+
+import random
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, IntegrityError
+from django.db.models import Count, F, Sum
+
+from taggit.models import (TagCount, GenericTaggedItemBase, atomic,
+    get_through_models)
+from taggit.utils import iter_chunks
+
+
+def usage_counts_enabled():
+    return getattr(settings, 'TAGGIT_USAGE_COUNTS', False)
+
+
+def has_usage_count(tag_model):
+    return 'usage_count' in tag_model._meta.get_all_field_names()
+
+
+def counts_enabled(tag_model):
+    return usage_counts_enabled() or has_usage_count(tag_model)
+
+
+def update_counts(tag_model, deltas, using=None):
+    """
+    Applies ``deltas``, a dict mapping ``(content_type_id, tag_pk)`` to the
+    change of the count, using one ``UPDATE`` per distinct change on the
+    ``using`` database, the one the links were written to.
+    """
+    from taggit.autocomplete import update_index_counts
+
+    deltas = dict((key, delta) for key, delta in deltas.items() if delta)
+    if not deltas:
+        return
+
+    totals = {}
+    for (ct, pk), delta in deltas.items():
+        totals[pk] = totals.get(pk, 0) + delta
+    update_index_counts(tag_model, totals)
+
+    if has_usage_count(tag_model):
+        for delta, pks in _group_by_value(totals).items():
+            tag_model._default_manager.using(using).filter(pk__in=pks).update(
+                usage_count=F('usage_count') + delta
+            )
+
+    if usage_counts_enabled():
+        by_content_type = {}
+        for (ct, pk), delta in deltas.items():
+            by_content_type.setdefault(ct, {})[pk] = delta
+        tag_type = ContentType.objects.get_for_model(tag_model)
+        for ct, ct_deltas in by_content_type.items():
+            _update_tag_counts(ct, tag_type, ct_deltas, using)
+
+
+def _update_tag_counts(content_type_id, tag_type, deltas, using=None):
+    if using is None:
+        using = router.db_for_write(TagCount)
+    shards = getattr(settings, 'TAGGIT_USAGE_COUNT_SHARDS', 1)
+    shard = random.randrange(shards)
+    counts = TagCount.objects.using(using).filter(
+        content_type=content_type_id, tag_type=tag_type, shard=shard
+    )
+    existing = set(counts.filter(
+        tag_id__in=list(deltas)
+    ).values_list('tag_id', flat=True))
+    for delta, pks in _group_by_value(
+            dict((pk, d) for pk, d in deltas.items() if pk in existing)).items():
+        counts.filter(tag_id__in=pks).update(count=F('count') + delta)
+
+    missing = [
+        TagCount(content_type_id=content_type_id, tag_type_id=tag_type.pk,
+                 tag_id=pk, shard=shard, count=delta)
+        for pk, delta in deltas.items()
+        if pk not in existing
+    ]
+    if not missing:
+        return
+    try:
+        with atomic(using=using):
+            TagCount.objects.using(using).bulk_create(missing)
+    except IntegrityError:
+        # Some rows were created concurrently.
+        for tag_count in missing:
+            if not counts.filter(tag_id=tag_count.tag_id).update(
+                    count=F('count') + tag_count.count):
+                tag_count.save(using=using)
+
+
+def tagged_with_counts(tag_model, content_type_id):
+    """
+    Returns the tags used on the model of ``content_type_id`` according to
+    the ``TagCount`` table.
+    """
+    return tag_model._default_manager.filter(pk__in=TagCount.objects.filter(
+        content_type=content_type_id,
+        tag_type=ContentType.objects.get_for_model(tag_model),
+        count__gt=0,
+    ).values('tag_id'))
+
+
+def with_counts(tag_qs, content_type_id=None):
+    """
+    Annotates ``tag_qs`` with ``num_times`` read from the counts, most used
+    first. The counts are those on the model of ``content_type_id``, or on
+    all models if it is ``None``.
+    """
+    tag_model = tag_qs.model
+    if usage_counts_enabled():
+        qn = connections[tag_qs.db].ops.quote_name
+        opts = TagCount._meta
+        sql = "SELECT COALESCE(SUM(%s), 0) FROM %s WHERE %s = %%s AND %s = %s.%s" % (
+            qn(opts.get_field('count').column),
+            qn(opts.db_table),
+            qn(opts.get_field('tag_type').column),
+            qn(opts.get_field('tag_id').column),
+            qn(tag_model._meta.db_table),
+            qn(tag_model._meta.pk.column),
+        )
+        params = (ContentType.objects.get_for_model(tag_model).pk,)
+        if content_type_id is not None:
+            sql += " AND %s = %%s" % qn(opts.get_field('content_type').column)
+            params += (content_type_id,)
+    else:
+        qn = connections[tag_qs.db].ops.quote_name
+        sql = "%s.%s" % (qn(tag_model._meta.db_table),
+                         qn(tag_model._meta.get_field('usage_count').column))
+        params = ()
+    return tag_qs.extra(
+        select={'num_times': sql}, select_params=params
+    ).order_by('-num_times')
+
+
+def with_total_counts(tag_qs):
+    """
+    Annotates ``tag_qs`` with ``num_times``, the number of times the tags are
+    used on all models, most used first. Without counts, a subquery per
+    through model counts the rows.
+    """
+    tag_model = tag_qs.model
+    if counts_enabled(tag_model):
+        return with_counts(tag_qs)
+    qn = connections[tag_qs.db].ops.quote_name
+    sql = " + ".join(
+        "(SELECT COUNT(*) FROM %s WHERE %s = %s.%s)" % (
+            qn(through._meta.db_table),
+            qn(through._meta.get_field('tag').column),
+            qn(tag_model._meta.db_table),
+            qn(tag_model._meta.pk.column),
+        )
+        for through in get_through_models(tag_model)
+    ) or "0"
+    return tag_qs.extra(select={'num_times': sql}).order_by('-num_times')
+
+
+def rebuild_counts():
+    """
+    Recomputes all the counts from the through tables.
+    """
+    counts = {}
+    totals = {}
+    for through in get_through_models():
+        tag_model = through.tag_model()._meta.concrete_model
+        if issubclass(through, GenericTaggedItemBase):
+            rows = through.objects.values_list(
+                'content_type', 'tag'
+            ).annotate(n=Count('pk')).order_by()
+        else:
+            ct = ContentType.objects.get_for_model(
+                through._meta.get_field('content_object').rel.to
+            ).pk
+            rows = (
+                (ct, tag, n) for tag, n in
+                through.objects.values_list('tag').annotate(
+                    n=Count('pk')).order_by()
+            )
+        tag_counts = counts.setdefault(tag_model, {})
+        tag_totals = totals.setdefault(tag_model, {})
+        for ct, tag, n in rows:
+            tag_counts[(ct, tag)] = tag_counts.get((ct, tag), 0) + n
+            tag_totals[tag] = tag_totals.get(tag, 0) + n
+
+    for tag_model, tag_totals in totals.items():
+        if has_usage_count(tag_model):
+            tag_model._default_manager.update(usage_count=0)
+            for n, pks in _group_by_value(tag_totals).items():
+                for chunk in iter_chunks(pks, 500):
+                    tag_model._default_manager.filter(pk__in=chunk).update(
+                        usage_count=n
+                    )
+
+    if usage_counts_enabled():
+        TagCount.objects.all().delete()
+        TagCount.objects.bulk_create([
+            TagCount(content_type_id=ct,
+                     tag_type=ContentType.objects.get_for_model(tag_model),
+                     tag_id=tag, count=n)
+            for tag_model, tag_counts in counts.items()
+            for (ct, tag), n in tag_counts.items()
+        ], batch_size=1000)
+
+
+def total_counts(tag_model, tag_qs):
+    """
+    Returns a dict mapping the primary keys of the tags in ``tag_qs`` to the
+    number of times they are used on all models, ``{}`` if the counts aren't
+    enabled.
+    """
+    if usage_counts_enabled():
+        return dict(TagCount.objects.filter(
+            tag_type=ContentType.objects.get_for_model(tag_model),
+            tag_id__in=tag_qs.values('pk'),
+        ).values_list('tag_id').annotate(Sum('count')).order_by())
+    if has_usage_count(tag_model):
+        return dict(tag_qs.values_list('pk', 'usage_count'))
+    return {}
+
+
+def _group_by_value(d):
+    groups = {}
+    for key, value in d.items():
+        groups.setdefault(value, []).append(key)
+    return groups
@@ -1,18 +1,39 @@
 from __future__ import unicode_literals
 
 from django import forms
+from django.forms.models import BaseInlineFormSet, BaseModelFormSet
 from django.utils.translation import ugettext as _
 from django.utils import six
 
-from taggit.utils import parse_tags, edit_string_for_tags
+from taggit.models import ItemBase
+from taggit.utils import parse_tags, edit_string_for_names
 
 
 class TagWidget(forms.TextInput):
+    """
+    A text input for tag strings. If ``autocomplete_url`` is given (e.g. the
+    URL of ``taggit.views.TagAutocomplete``), it is rendered as the
+    ``data-autocomplete-url`` attribute for scripts to suggest tags from.
+    """
+    def __init__(self, attrs=None, autocomplete_url=None):
+        if autocomplete_url is not None:
+            attrs = dict(attrs or {}, **{'data-autocomplete-url': autocomplete_url})
+        super(TagWidget, self).__init__(attrs)
+
     def render(self, name, value, attrs=None):
         if value is not None and not isinstance(value, six.string_types):
-            value = edit_string_for_tags([o.tag for o in value.select_related("tag")])
+            value = edit_string_for_names(_tag_names(value))
         return super(TagWidget, self).render(name, value, attrs)
 
+
+def _tag_names(value):
+    # ``value`` is usually the tags from ``TaggableManager.value_from_object()``
+    # (prefetched ones included), but through rows and names are accepted too.
+    if issubclass(getattr(value, 'model', object), ItemBase):
+        value = [o.tag for o in value.select_related("tag")]
+    return [t if isinstance(t, six.string_types) else t.name for t in value]
+
+
 class TagField(forms.CharField):
     widget = TagWidget
 
@@ -22,3 +43,38 @@ class TagField(forms.CharField):
             return parse_tags(value)
         except ValueError:
             raise forms.ValidationError(_("Please provide a comma-separated list of tags."))
+
+
+def prefetch_tags(queryset):
+    """
+    Returns ``queryset`` prefetching the tags of all its ``TaggableManager``
+    fields, so that the tags of all the objects are read in one query per
+    field.
+    """
+    from taggit.managers import TaggableManager
+    return queryset.prefetch_related(*[
+        f.name for f in queryset.model._meta.many_to_many
+        if isinstance(f, TaggableManager)
+    ])
+
+
+class _PrefetchTagsMixin(object):
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            self._queryset = prefetch_tags(
+                super(_PrefetchTagsMixin, self).get_queryset())
+        return self._queryset
+
+
+class BaseTaggableModelFormSet(_PrefetchTagsMixin, BaseModelFormSet):
+    """
+    A model formset rendering the tags of all its forms with one query, use
+    it as the ``formset`` argument of ``modelformset_factory()``.
+    """
+
+
+class BaseTaggableInlineFormSet(_PrefetchTagsMixin, BaseInlineFormSet):
+    """
+    The ``inlineformset_factory()`` counterpart of
+    ``BaseTaggableModelFormSet``.
+    """
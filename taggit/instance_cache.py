@@ -0,0 +1,139 @@
+"""
+Caching of the tags of each tagged object.
+
+If the ``TAGGIT_INSTANCE_CACHE`` setting names a cache (an alias of the
+``CACHES`` setting), ``names()`` on the tag manager of an instance reads the
+primary keys and names of its tags from that cache, and ``prefetch_cached()``
+on the manager of a model loads those of a list of instances with a single
+``get_many()``. Entries are ``(generation, pks, names)`` tuples of ints and
+strings, to stay small in memcached.
+
+The tag managers delete the entries of the objects whose links they change.
+Saving or deleting a tag can change the tags of any number of objects, so it
+starts a new generation of the tag model instead, and the entries of previous
+generations are ignored. Through rows changed without the tag managers aren't
+noticed.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.utils import six
+from django.utils.encoding import smart_bytes
+
+try:
+    from django.core.cache import caches
+except ImportError:  # django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+
+# Bumped whenever the format of the keys or of the entries changes.
+KEY_VERSION = 1
+
+
+def instance_cache():
+    """
+    Returns the cache the tags of the objects are kept in, or ``None`` if
+    the instance cache is disabled.
+    """
+    alias = getattr(settings, 'TAGGIT_INSTANCE_CACHE', None)
+    if alias is None:
+        return None
+    return get_cache(alias)
+
+
+def _timeout_kwargs():
+    # Left out by default, so that the backend's default timeout applies on
+    # every Django version.
+    timeout = getattr(settings, 'TAGGIT_INSTANCE_CACHE_TIMEOUT', None)
+    return {} if timeout is None else {'timeout': timeout}
+
+
+def _model_label(model):
+    opts = model._meta.concrete_model._meta
+    return '%s.%s' % (opts.app_label, opts.object_name.lower())
+
+
+def cache_key(through, key):
+    """
+    Returns the cache key of the tags linked by ``through`` to the object
+    with the ``(content_type_id, object_id)`` ``key``.
+    """
+    ct, pk = key
+    if not isinstance(pk, six.integer_types):
+        # Keeps arbitrary primary keys within memcached's key rules.
+        pk = hashlib.md5(smart_bytes(pk)).hexdigest()
+    return 'taggit.tags.%d.%s.%s.%s' % (KEY_VERSION, _model_label(through),
+                                        ct, pk)
+
+
+def _generation_key(tag_model):
+    return 'taggit.tags.%d.%s.generation' % (KEY_VERSION,
+                                             _model_label(tag_model))
+
+
+def get_cached(cache, through, keys):
+    """
+    Reads the tags of the objects with the given ``keys`` with a single
+    ``get_many()``. Returns a dict mapping the keys found to ``(pks, names)``
+    tuples, and the current generation, to store the missing ones with.
+    """
+    generation_key = _generation_key(through.tag_model())
+    keys_by_cache_key = dict((cache_key(through, key), key) for key in keys)
+    values = cache.get_many([generation_key] + list(keys_by_cache_key))
+    generation = values.pop(generation_key, None)
+    if generation is None:
+        # Without its generation no entry can be trusted, they might have
+        # been stored before the last change of a tag.
+        generation = _new_generation_value()
+        if not cache.add(generation_key, generation, **_timeout_kwargs()):
+            generation = cache.get(generation_key, generation)
+        return {}, generation
+    found = {}
+    for k, value in values.items():
+        if value[0] == generation:
+            found[keys_by_cache_key[k]] = value[1:]
+    return found, generation
+
+
+def set_cached(cache, through, tags_by_key, generation):
+    """
+    Stores ``tags_by_key``, a dict mapping object keys to ``(pks, names)``
+    tuples read during ``generation``.
+    """
+    cache.set_many(dict(
+        (cache_key(through, key), (generation, tuple(pks), tuple(names)))
+        for key, (pks, names) in tags_by_key.items()
+    ), **_timeout_kwargs())
+
+
+def invalidate_objects(through, keys):
+    """
+    Drops the cached tags of the objects with the given ``keys``.
+    """
+    cache = instance_cache()
+    if cache is not None and keys:
+        cache.delete_many([cache_key(through, key) for key in keys])
+
+
+def new_generation(sender, instance, created=False, **kwargs):
+    """
+    Invalidates the cached tags of all the objects tagged with ``sender``
+    tags. Connected to the signals of the tag models.
+    """
+    cache = instance_cache()
+    if cache is None or created:
+        return
+    cache.set(_generation_key(sender), _new_generation_value(),
+              **_timeout_kwargs())
+
+
+def _new_generation_value():
+    # A fresh value rather than an increment: if the key is evicted, a
+    # counter could start over and revive the entries of an old generation.
+    return int(time.time() * 1000000)
@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from taggit.transfer import export_tags, write_rows
+
+
+class _TextWriter(object):
+    # write_rows() writes bytes, the stdout of commands takes text.
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(data.decode('utf-8'))
+
+
+class Command(BaseCommand):
+    args = "[<file>]"
+    help = ("Writes the tags of every tagged object as JSONL or CSV "
+            "(app_label.model, object_id, tags) rows.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help="The number of objects whose tags are fetched per query."),
+        make_option('--format', choices=['jsonl', 'csv'],
+            help="The format of the file, guessed from its extension by "
+                 "default."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Expected at most the path of the file to "
+                               "write.")
+        path = args[0] if args else None
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'csv' if path and path.lower().endswith('.csv') else 'jsonl'
+
+        rows = export_tags(batch_size=options['batch_size'])
+        if path is None:
+            write_rows(_TextWriter(self.stdout), rows, file_format)
+            return
+        with open(path, 'wb') as f:
+            count = write_rows(f, rows, file_format)
+        self.stdout.write("%d rows written to %s" % (count, path))
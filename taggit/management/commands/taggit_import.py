@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from taggit.transfer import TagImporter, read_rows
+from taggit.utils import iter_chunks
+
+
+class Command(BaseCommand):
+    args = "<file>"
+    help = ("Tags objects from a JSONL or CSV file of "
+            "(app_label.model, object_id, tags) rows.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help="The number of rows imported per transaction."),
+        make_option('--format', choices=['jsonl', 'csv'],
+            help="The format of the file, guessed from its extension by "
+                 "default."),
+        make_option('--offset', type='int', default=0,
+            help="The byte offset to resume importing from."),
+        make_option('--dry-run', action='store_true', default=False,
+            help="Only check the rows, without tagging anything."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Expected the path of the file to import.")
+        path = args[0]
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+        importer = TagImporter(dry_run=options['dry_run'])
+        with open(path, 'rb') as f:
+            f.seek(options['offset'])
+            try:
+                rows = read_rows(f, file_format)
+                for chunk in iter_chunks(rows, options['batch_size']):
+                    importer.import_rows([row for offset, row in chunk])
+                    self.stdout.write("%d rows %s, %d skipped, next offset %d" % (
+                        importer.imported,
+                        "checked" if importer.dry_run else "imported",
+                        importer.skipped, chunk[-1][0]))
+            except ValueError as e:
+                raise CommandError(e)
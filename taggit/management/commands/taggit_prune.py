@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from taggit.models import get_through_models, prune_tags
+
+
+class Command(NoArgsCommand):
+    help = "Deletes the tags which aren't used by any through model."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help="The number of tags deleted per transaction."),
+        make_option('--sleep', type='float', default=0.1,
+            help="The number of seconds to wait between batches."),
+    )
+
+    def handle_noargs(self, **options):
+        tag_models = []
+        for through in get_through_models():
+            tag_model = through.tag_model()._meta.concrete_model
+            if tag_model not in tag_models:
+                tag_models.append(tag_model)
+
+        for tag_model in tag_models:
+            name = tag_model._meta.object_name
+
+            def progress(deleted):
+                self.stdout.write("%s: %d unused tags deleted" % (name, deleted))
+
+            deleted = prune_tags(tag_model, options['batch_size'],
+                                 options['sleep'], progress)
+            if not deleted:
+                self.stdout.write("%s: no unused tags" % name)
@@ -0,0 +1,12 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import NoArgsCommand
+
+from taggit.counts import rebuild_counts
+
+
+class Command(NoArgsCommand):
+    help = "Recomputes the tag usage counts from the through tables."
+
+    def handle_noargs(self, **options):
+        rebuild_counts()
@@ -0,0 +1,15 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import NoArgsCommand
+
+from taggit.models import get_through_models
+from taggit.similar import rebuild_similar_items, similar_items_enabled
+
+
+class Command(NoArgsCommand):
+    help = "Recomputes the precomputed similar objects from the through tables."
+
+    def handle_noargs(self, **options):
+        for through in get_through_models():
+            if similar_items_enabled(through):
+                rebuild_similar_items(through)
@@ -1,5 +1,5 @@
 from __future__ import unicode_literals
-from operator import attrgetter
+from operator import attrgetter, itemgetter
 
 from django import VERSION
 try:
@@ -7,9 +7,16 @@ try:
 except ImportError:  # django < 1.7
     from django.contrib.contenttypes.generic import GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, router
+from django.db import connections, models, router, IntegrityError
 from django.db.models.fields import Field
 from django.db.models.fields.related import ManyToManyRel, RelatedField, add_lazy_relation
+from django.db.models.query import QuerySet
+from django.db.models.query_utils import deferred_class_factory
+from django.db.models.signals import pre_delete
+try:
+    from django.db.models.signals import post_migrate
+except ImportError:  # django < 1.7
+    from django.db.models.signals import post_syncdb as post_migrate
 from django.db.models.related import RelatedObject
 from django.utils.text import capfirst
 from django.utils.translation import ugettext_lazy as _
@@ -20,9 +27,18 @@ try:
 except ImportError:
     pass  # PathInfo is not used on Django < 1.6
 
+from taggit.autocomplete import update_index_tags
+from taggit.cache import tag_cache
+from taggit.counts import (counts_enabled, usage_counts_enabled,
+    update_counts, tagged_with_counts, with_counts)
 from taggit.forms import TagField
-from taggit.models import TaggedItem, GenericTaggedItemBase
-from taggit.utils import require_instance_manager
+from taggit.instance_cache import (instance_cache, get_cached, set_cached,
+    invalidate_objects)
+from taggit.models import (TaggedItem, GenericTaggedItemBase, SimilarItem,
+    atomic, delete_orphans_enabled, delete_orphan_tags, _bulk_insert_ignore)
+from taggit.similar import (similar_items_enabled, similar_items_limit,
+    refreshes_similar_items, object_key, object_keys, stored_similar)
+from taggit.utils import require_instance_manager, iter_chunks
 
 
 def _model_name(model):
@@ -73,46 +89,92 @@ class ExtraJoinRestriction(object):
 
 
 class _TaggableManager(models.Manager):
+    # The number of objects handled per query by the bulk methods.
+    bulk_batch_size = 500
+    # The number of objects whose tags are fetched per query by
+    # prefetch_related().
+    prefetch_batch_size = 500
+
     def __init__(self, through, model, instance, prefetch_cache_name):
         self.through = through
         self.model = model
         self.instance = instance
         self.prefetch_cache_name = prefetch_cache_name
         self._db = None
+        # The objects whose links changed, see refreshes_similar_items().
+        self._similar_keys = None
 
     def is_cached(self, instance):
-        return self.prefetch_cache_name in instance._prefetched_objects_cache
+        return self.prefetch_cache_name in getattr(
+            instance, '_prefetched_objects_cache', {})
 
     def get_queryset(self):
         try:
             return self.instance._prefetched_objects_cache[self.prefetch_cache_name]
         except (AttributeError, KeyError):
-            return self.through.tags_for(self.model, self.instance)
+            return self.through.tags_for(self.model, self.instance).using(
+                self._db_for_read(self.through.tag_model()))
 
-    def get_prefetch_queryset(self, instances, queryset=None):
-        if queryset is not None:
-            raise ValueError("Custom queryset can't be used for this lookup.")
+    def _db_for_read(self, model=None):
+        """
+        Returns the alias reads of ``model`` (by default the through model)
+        go to: the one given with ``db_manager()``, or the router's choice.
+        """
+        return self._db or router.db_for_read(model or self.through,
+                                              **self._hints())
 
+    def _db_for_write(self):
+        """
+        Returns the single alias all the writes of an operation go to, tags
+        and through rows alike.
+        """
+        return self._db or router.db_for_write(self.through, **self._hints())
+
+    def _hints(self):
+        if self.instance is None:
+            return {}
+        return {'instance': self.instance}
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        """
+        Fetches the tags of ``instances`` for ``prefetch_related()``, using
+        one query per ``prefetch_batch_size`` instances. ``queryset`` is the
+        tag queryset given with ``Prefetch('tags', queryset=...)``.
+        """
+        if queryset is None:
+            queryset = self.through.tag_model()._default_manager.all()
         instance = instances[0]
-        from django.db import connections
-        db = self._db or router.db_for_read(instance.__class__, instance=instance)
-
-        fieldname = ('object_id' if issubclass(self.through, GenericTaggedItemBase)
-                     else 'content_object')
-        fk = self.through._meta.get_field(fieldname)
-        query = {
-            '%s__%s__in' % (self.through.tag_relname(), fk.name) :
-                set(obj._get_pk_val() for obj in instances)
-        }
-        join_table = self.through._meta.db_table
-        source_col = fk.column
-        connection = connections[db]
-        qn = connection.ops.quote_name
-        qs = self.get_queryset().using(db)._next_is_sticky().filter(**query).extra(
-            select = {
-                '_prefetch_related_val' : '%s.%s' % (qn(join_table), qn(source_col))
-            }
-        )
+        db = self._db or router.db_for_read(queryset.model, instance=instance)
+        queryset = queryset.using(db)
+
+        # All the conditions on the through table go in a single filter() call
+        # so that they apply to the same join.
+        relname = self.through.tag_relname()
+        fk = _object_field(self.through)
+        lookup = {}
+        if issubclass(self.through, GenericTaggedItemBase):
+            lookup['%s__content_type' % relname] = self._content_type_id(self.model)
+        source = '%s__%s' % (relname, fk.name)
+
+        pks = list(set(obj._get_pk_val() for obj in instances))
+        querysets = []
+        for chunk in iter_chunks(pks, self.prefetch_batch_size):
+            lookup['%s__in' % source] = chunk
+            qs = queryset.filter(**lookup)
+            if VERSION >= (1, 8):
+                qs = qs.annotate(_prefetch_related_val=models.F(source))
+            else:
+                qn = connections[db].ops.quote_name
+                qs = qs.extra(select={
+                    '_prefetch_related_val': '%s.%s' % (
+                        qn(self.through._meta.db_table), qn(fk.column))
+                })
+            querysets.append(qs)
+        if len(querysets) == 1:
+            qs = querysets[0]
+        else:
+            # Each chunk runs its own nested prefetch lookups, if any.
+            qs = [obj for qs in querysets for obj in qs]
         return (qs,
                 attrgetter('_prefetch_related_val'),
                 attrgetter(instance._meta.pk.name),
@@ -126,91 +188,648 @@ class _TaggableManager(models.Manager):
     def _lookup_kwargs(self):
         return self.through.lookup_kwargs(self.instance)
 
+    def _to_tag_model_instances(self, tags, using=None):
+        """
+        Takes an iterable containing either strings, tag objects, or a mixture
+        of both and returns a list of distinct tag objects, creating the
+        missing ones in bulk on the ``using`` database.
+        """
+        tag_model = self.through.tag_model()
+        using = using or self._db_for_write()
+        tag_objs = {}
+        str_tags = set()
+        for t in tags:
+            if isinstance(t, tag_model):
+                tag_objs[t.pk] = t
+            else:
+                str_tags.add(t)
+
+        if tag_cache.enabled:
+            for name in list(str_tags):
+                pk = tag_cache.get(tag_model, 'name', name)
+                if pk is not None:
+                    tag_objs.setdefault(pk, _cached_tag(tag_model, pk, name))
+                    str_tags.discard(name)
+
+        if str_tags:
+            existing = list(tag_model.objects.using(using).filter(
+                name__in=str_tags))
+            created = self._create_tags(
+                str_tags - set(t.name for t in existing), using
+            )
+            update_index_tags(tag_model, created)
+            for tag in existing + created:
+                tag_cache.add(tag)
+                tag_objs.setdefault(tag.pk, tag)
+        return list(tag_objs.values())
+
+    def _create_tags(self, names, using):
+        """
+        Creates tags for ``names`` with a single ``INSERT`` and reads them
+        back to get their primary keys.
+
+        Where the database can skip the rows which conflict with existing
+        ones, tags created concurrently by another process are simply read
+        back. The tags whose slug is taken by a tag with another name get
+        free slugs with ``_assign_slugs()`` and are inserted again.
+        """
+        if not names:
+            return []
+        tag_model = self.through.tag_model()
+        tags = []
+        for name in sorted(names):
+            tag = tag_model(name=name)
+            tag.slug = tag.slugify(name)
+            tags.append(tag)
+
+        created = []
+        for attempt in range(tag_model.slug_attempts):
+            if not _bulk_insert_ignore(tag_model, tags, using):
+                break
+            read = self._read_tags(tags, using)
+            created.extend(read)
+            names = set(t.name for t in read)
+            tags = [t for t in tags if t.name not in names]
+            if not tags:
+                return created
+            self._assign_slugs(tags, using)
+        return created + self._create_tags_locking(tags, using)
+
+    def _create_tags_locking(self, tags, using):
+        # Relies on IntegrityError for databases without an insert which
+        # skips conflicting rows.
+        tag_model = self.through.tag_model()
+        if len(set(t.slug for t in tags)) == len(tags):
+            try:
+                with atomic(using=using):
+                    _bulk_create(tag_model, tags, using)
+                return self._read_tags(tags, using)
+            except IntegrityError:
+                pass
+
+        self._assign_slugs(tags, using)
+        try:
+            with atomic(using=using):
+                _bulk_create(tag_model, tags, using)
+        except IntegrityError:
+            # The slugs got taken meanwhile, fall back to the slow path.
+            for tag in tags:
+                tag.slug = ""
+                tag.save(using=using)
+            return tags
+        return self._read_tags(tags, using)
+
+    def _assign_slugs(self, tags, using):
+        """
+        Gives the ``tags`` whose slug is taken, or used by an earlier tag in
+        ``tags``, the next free suffixed slug. This takes one query per batch
+        of tags plus one per colliding slug.
+        """
+        tag_model = self.through.tag_model()
+        taken = set()
+        for chunk in iter_chunks(tags, self.bulk_batch_size):
+            taken.update(tag_model._default_manager.using(using).filter(
+                slug__in=[t.slug for t in chunk]
+            ).values_list('slug', flat=True))
+        slugs = set()
+        indexes = {}
+        for tag in tags:
+            if tag.slug in taken or tag.slug in slugs:
+                base = tag.slug
+                i = indexes.get(base) or tag.next_slug_index(using)
+                tag.slug = tag.slugify(tag.name, i)
+                while tag.slug in slugs or tag.slug in taken:
+                    i += 1
+                    tag.slug = tag.slugify(tag.name, i)
+                indexes[base] = i + 1
+            slugs.add(tag.slug)
+
+    def _read_tags(self, tags, using):
+        return list(self.through.tag_model().objects.using(using).filter(
+            name__in=[t.name for t in tags]
+        ))
+
+    def _content_type_id(self, obj):
+        """
+        Returns the id of the content type the usage counts of ``obj`` (an
+        instance or a model) are kept under.
+        """
+        if not issubclass(self.through, GenericTaggedItemBase):
+            obj = _object_field(self.through).rel.to
+        return ContentType.objects.get_for_model(obj).pk
+
+    def _create_links(self, links, using):
+        """
+        Creates the through rows for ``links``, a list of ``(obj, tag)``
+        pairs, and counts them. Links created concurrently by another
+        operation are skipped.
+        """
+        if not links:
+            return
+        tag_model = self.through.tag_model()
+        rows = [self.through(tag=tag, **self.through.lookup_kwargs(obj))
+                for obj, tag in links]
+        if (counts_enabled(tag_model) or
+                not _bulk_insert_ignore(self.through, rows, using)):
+            links = self._insert_links(links, rows, using)
+        keys = set(object_key(self.through, obj) for obj, tag in links)
+        if self._similar_keys is not None:
+            self._similar_keys.update(keys)
+        invalidate_objects(self.through, keys)
+        self._forget_loaded(obj for obj, tag in links)
+
+        if counts_enabled(tag_model):
+            deltas = {}
+            for obj, tag in links:
+                key = (self._content_type_id(obj), tag.pk)
+                deltas[key] = deltas.get(key, 0) + 1
+            update_counts(tag_model, deltas, using)
+
+    def _insert_links(self, links, rows, using):
+        # Returns the links whose rows were actually inserted, so that the
+        # ones made concurrently, and counted, by another operation aren't
+        # counted twice.
+        try:
+            with atomic(using=using):
+                _bulk_create(self.through, rows, using)
+            return links
+        except IntegrityError:
+            pass
+        created = []
+        for link, row in zip(links, rows):
+            try:
+                with atomic(using=using):
+                    row.save(using=using, force_insert=True)
+            except IntegrityError:
+                continue
+            created.append(link)
+        return created
+
+    def _delete_links(self, qs):
+        """
+        Deletes the through rows in ``qs`` and counts them. If
+        ``TAGGIT_DELETE_ORPHANS`` is enabled, the tags which aren't used
+        anymore are deleted too.
+        """
+        keys = None
+        if self._similar_keys is not None or instance_cache() is not None:
+            keys = object_keys(self.through, qs)
+        if self._similar_keys is not None:
+            self._similar_keys.update(keys)
+        if self.instance is not None:
+            self._forget_loaded([self.instance])
+        tag_model = self.through.tag_model()
+        counting = counts_enabled(tag_model)
+        pruning = delete_orphans_enabled()
+        if not counting and not pruning:
+            qs.delete()
+            invalidate_objects(self.through, keys)
+            return
+
+        if not counting:
+            deltas = dict(((None, tag), 0) for tag in
+                          qs.values_list('tag', flat=True).distinct())
+        elif issubclass(self.through, GenericTaggedItemBase):
+            rows = qs.values_list('content_type', 'tag').annotate(
+                n=models.Count('pk')).order_by()
+            deltas = dict(((ct, tag), -n) for ct, tag, n in rows)
+        else:
+            ct = self._content_type_id(self.model)
+            rows = qs.values_list('tag').annotate(n=models.Count('pk')).order_by()
+            deltas = dict(((ct, tag), -n) for tag, n in rows)
+        qs.delete()
+        invalidate_objects(self.through, keys)
+        if counting:
+            update_counts(tag_model, deltas, qs.db)
+        if pruning and deltas:
+            delete_orphan_tags(tag_model, set(tag for ct, tag in deltas), qs.db)
+
+    def _link(self, tag_objs, using):
+        self._create_links([(self.instance, tag) for tag in tag_objs], using)
+
+    def _unlink(self, tag_objs, using):
+        self._delete_links(self.through.objects.using(using).filter(
+            tag__in=tag_objs, **self._lookup_kwargs()))
+
     @require_instance_manager
+    @refreshes_similar_items
     def add(self, *tags):
-        str_tags = set([
-            t
-            for t in tags
-            if not isinstance(t, self.through.tag_model())
-        ])
-        tag_objs = set(tags) - str_tags
-        # If str_tags has 0 elements Django actually optimizes that to not do a
-        # query.  Malcolm is very smart.
-        existing = self.through.tag_model().objects.filter(
-            name__in=str_tags
-        )
-        tag_objs.update(existing)
-
-        for new_tag in str_tags - set(t.name for t in existing):
-            tag_objs.add(self.through.tag_model().objects.create(name=new_tag))
+        using = self._db_for_write()
+        tag_objs = self._to_tag_model_instances(tags, using)
+        if not tag_objs:
+            return
+
+        # Only link the tags which are not linked already.
+        existing = set(self.through.objects.using(using).filter(
+            tag__in=tag_objs, **self._lookup_kwargs()
+        ).values_list('tag', flat=True))
+        self._link([t for t in tag_objs if t.pk not in existing], using)
+
+    def _iter_chunks(self, objs, get_obj=None):
+        """
+        Yields batches of at most ``bulk_batch_size`` items of ``objs``. With
+        a generic through model the objects of a batch are all of the same
+        content type, as ``bulk_lookup_kwargs()`` requires; ``get_obj``
+        returns the object of an item if they aren't the objects themselves.
+        """
+        if isinstance(objs, QuerySet):
+            return iter_chunks(objs.iterator(), self.bulk_batch_size)
+        if not issubclass(self.through, GenericTaggedItemBase):
+            return iter_chunks(objs, self.bulk_batch_size)
+        groups = {}
+        models_ = []
+        for item in objs:
+            # Content types are those of the concrete models, so
+            # multi-table subclasses get their own group.
+            model = (get_obj(item) if get_obj else item)._meta.concrete_model
+            if model not in groups:
+                groups[model] = []
+                models_.append(model)
+            groups[model].append(item)
+        return (chunk for model in models_
+                for chunk in iter_chunks(groups[model], self.bulk_batch_size))
+
+    @refreshes_similar_items
+    def add_to(self, objs, *tags):
+        """
+        Adds ``tags`` to every object in ``objs``, a ``QuerySet`` or a list of
+        instances, using a constant number of queries per batch of objects.
+        """
+        using = self._db_for_write()
+        tag_objs = self._to_tag_model_instances(tags, using)
+        if not tag_objs:
+            return
+        field_name = _object_field(self.through).name
+        for chunk in self._iter_chunks(objs):
+            existing = set(self.through.objects.using(using).filter(
+                tag__in=tag_objs, **self.through.bulk_lookup_kwargs(chunk)
+            ).values_list(field_name, 'tag'))
+            self._create_links([
+                (obj, tag)
+                for obj in chunk
+                for tag in tag_objs
+                if (obj.pk, tag.pk) not in existing
+            ], using)
+
+    @refreshes_similar_items
+    def add_to_each(self, tags_by_obj):
+        """
+        Adds its own tags to every object in ``tags_by_obj``, a list of
+        ``(obj, tags)`` pairs, using a constant number of queries per batch of
+        objects.
+        """
+        tag_model = self.through.tag_model()
+        using = self._db_for_write()
+        tag_objs = self._to_tag_model_instances(
+            (t for obj, tags in tags_by_obj for t in tags), using)
+        by_name = dict((t.name, t) for t in tag_objs)
+        field_name = _object_field(self.through).name
+        for chunk in self._iter_chunks(tags_by_obj, itemgetter(0)):
+            wanted = [
+                (obj, t if isinstance(t, tag_model) else by_name[t])
+                for obj, tags in chunk
+                for t in tags
+            ]
+            if not wanted:
+                continue
+            existing = set(self.through.objects.using(using).filter(
+                tag__in=set(tag for obj, tag in wanted),
+                **self.through.bulk_lookup_kwargs([obj for obj, tags in chunk])
+            ).values_list(field_name, 'tag'))
+            links = []
+            for obj, tag in wanted:
+                if (obj.pk, tag.pk) not in existing:
+                    existing.add((obj.pk, tag.pk))
+                    links.append((obj, tag))
+            self._create_links(links, using)
+
+    @refreshes_similar_items
+    def remove_from(self, objs, *tags):
+        """
+        Removes ``tags`` from every object in ``objs``.
+        """
+        if not tags:
+            return
+        tag_model = self.through.tag_model()
+        names = [t for t in tags if not isinstance(t, tag_model)]
+        tag_objs = [t for t in tags if isinstance(t, tag_model)]
+        using = self._db_for_write()
+        self._forget_loaded(objs)
+        for lookup in self._bulk_lookups(objs, using):
+            self._delete_links(self.through.objects.using(using).filter(
+                **lookup).filter(
+                models.Q(tag__name__in=names) | models.Q(tag__in=tag_objs)
+            ))
+
+    @refreshes_similar_items
+    def set_on(self, objs, *tags):
+        """
+        Makes ``tags`` the only tags of every object in ``objs``.
+        """
+        using = self._db_for_write()
+        tag_objs = self._to_tag_model_instances(tags, using)
+        if not tag_objs:
+            return self.clear_on(objs)
+        field_name = _object_field(self.through).name
+        rows = self.through.objects.using(using)
+        for chunk in self._iter_chunks(objs):
+            self._forget_loaded(chunk)
+            lookup = self.through.bulk_lookup_kwargs(chunk)
+            self._delete_links(rows.filter(**lookup).exclude(tag__in=tag_objs))
+            existing = set(rows.filter(
+                tag__in=tag_objs, **lookup
+            ).values_list(field_name, 'tag'))
+            self._create_links([
+                (obj, tag)
+                for obj in chunk
+                for tag in tag_objs
+                if (obj.pk, tag.pk) not in existing
+            ], using)
+
+    @refreshes_similar_items
+    def clear_on(self, objs):
+        """
+        Removes all tags from every object in ``objs``.
+        """
+        using = self._db_for_write()
+        self._forget_loaded(objs)
+        for lookup in self._bulk_lookups(objs, using):
+            self._delete_links(self.through.objects.using(using).filter(**lookup))
+
+    def _bulk_lookups(self, objs, using):
+        # A QuerySet can be used as a subquery, so there is no need to fetch
+        # the objects at all. It has to run on the database of the query.
+        if isinstance(objs, QuerySet):
+            return [self.through.bulk_lookup_kwargs(objs.using(using))]
+        return [
+            self.through.bulk_lookup_kwargs(chunk)
+            for chunk in self._iter_chunks(objs)
+        ]
+
+    def filter_tags(self, queryset=None, all=(), any=(), none=()):
+        """
+        Returns the objects of ``queryset`` (all the objects by default)
+        tagged with all of the ``all`` tags, at least one of the ``any`` tags
+        and none of the ``none`` tags. Tags are given as names or tag objects.
 
-        for tag in tag_objs:
-            self.through.objects.get_or_create(tag=tag, **self._lookup_kwargs())
+        Each condition is a single subquery on the through table: ``all`` is
+        grouped by object with a ``HAVING COUNT(DISTINCT tag)`` check, and
+        ``none`` is an excluding subquery.
+        """
+        if queryset is None:
+            queryset = self.model._default_manager.all()
+            if self._db:
+                queryset = queryset.using(self._db)
+        field = _object_field(self.through).name
+        if all:
+            # A tag can be given both by name and as an object.
+            tag_model = self.through.tag_model()
+            required = set(t.name if isinstance(t, tag_model) else t
+                           for t in all)
+            tagged = self._tagged_with(all, queryset.db)
+            queryset = queryset.filter(pk__in=tagged.values(field).annotate(
+                n=models.Count('tag', distinct=True)
+            ).filter(n=len(required)).values(field))
+        if any:
+            queryset = queryset.filter(
+                pk__in=self._tagged_with(any, queryset.db).values(field))
+        if none:
+            queryset = queryset.exclude(
+                pk__in=self._tagged_with(none, queryset.db).values(field))
+        return queryset
+
+    def _tagged_with(self, tags, using):
+        # The through rows of the objects of this manager's model (and its
+        # subclasses) with any of ``tags``, used as subqueries on ``using``.
+        tag_model = self.through.tag_model()
+        names = [t for t in tags if not isinstance(t, tag_model)]
+        tag_objs = [t for t in tags if isinstance(t, tag_model)]
+        q = models.Q()
+        if names:
+            q |= models.Q(tag__name__in=names)
+        if tag_objs:
+            q |= models.Q(tag__in=tag_objs)
+        qs = self.through.objects.using(using).filter(q)
+        if issubclass(self.through, GenericTaggedItemBase):
+            field = self.model._meta.get_field(self.prefetch_cache_name)
+            qs = qs.filter(content_type__in=field._get_content_type_ids())
+        return qs
 
     @require_instance_manager
     def names(self):
+        """
+        Returns the names of the tags, as a list read from the instance cache
+        if it's enabled and the tags aren't prefetched.
+        """
+        loaded = self._loaded_tags()
+        if loaded is not None:
+            return list(loaded[1])
         return self.get_queryset().values_list('name', flat=True)
 
+    def _loaded_tags(self):
+        # The (pks, names) of the tags loaded by prefetch_cached(), which is
+        # called on demand if the instance cache is enabled.
+        if self.is_cached(self.instance):
+            return None
+        loaded = self.instance.__dict__.get('_cached_tag_names', {})
+        if self.prefetch_cache_name not in loaded:
+            if instance_cache() is None:
+                return None
+            self.prefetch_cached([self.instance])
+        return self.instance._cached_tag_names[self.prefetch_cache_name]
+
+    def prefetch_cached(self, objs):
+        """
+        Loads the primary keys and names of the tags of ``objs`` for their
+        ``names()``: from the instance cache with a single ``get_many()`` if
+        it's enabled, and the missing ones with one query per
+        ``prefetch_batch_size`` objects, which are then cached.
+        """
+        objs = [obj for obj in objs if obj.pk is not None]
+        keys = [object_key(self.through, obj) for obj in objs]
+        cache = instance_cache()
+        found = {}
+        if cache is not None and objs:
+            found, generation = get_cached(cache, self.through, keys)
+        missing = [obj for obj, key in zip(objs, keys) if key not in found]
+        if missing:
+            read = self._read_tag_names(missing)
+            if cache is not None:
+                set_cached(cache, self.through, read, generation)
+            found.update(read)
+        for obj, key in zip(objs, keys):
+            obj.__dict__.setdefault('_cached_tag_names', {})[
+                self.prefetch_cache_name] = found[key]
+
+    def _read_tag_names(self, objs):
+        field = _object_field(self.through).name
+        rows = self.through.objects.using(self._db_for_read()).order_by(
+            'tag__name')
+        by_content_type = {}
+        for obj in objs:
+            ct, pk = object_key(self.through, obj)
+            by_content_type.setdefault(ct, []).append(obj)
+        tags = {}
+        for ct, ct_objs in by_content_type.items():
+            for chunk in iter_chunks(ct_objs, self.prefetch_batch_size):
+                for obj in chunk:
+                    tags[(ct, obj.pk)] = ([], [])
+                for pk, tag, name in rows.filter(
+                        **self.through.bulk_lookup_kwargs(chunk)
+                ).values_list(field, 'tag', 'tag__name'):
+                    pks, names = tags[(ct, pk)]
+                    pks.append(tag)
+                    names.append(name)
+        return dict((key, (tuple(pks), tuple(names)))
+                    for key, (pks, names) in tags.items())
+
+    def _forget_loaded(self, objs):
+        if isinstance(objs, QuerySet):
+            return
+        for obj in objs:
+            obj.__dict__.get('_cached_tag_names', {}).pop(
+                self.prefetch_cache_name, None)
+
     @require_instance_manager
     def slugs(self):
         return self.get_queryset().values_list('slug', flat=True)
 
     @require_instance_manager
+    @refreshes_similar_items
     def set(self, *tags):
-        self.clear()
-        self.add(*tags)
+        """
+        Replaces the tags of the object with ``tags``, only touching the links
+        which actually change.
+
+        Returns a tuple ``(added, removed)`` of lists of tag objects, both are
+        empty if the tags didn't change.
+        """
+        using = self._db_for_write()
+        tag_objs = self._to_tag_model_instances(tags, using)
+        current = list(self.through.tags_for(self.model, self.instance).using(
+            using))
+        new_pks = set(t.pk for t in tag_objs)
+        current_pks = set(t.pk for t in current)
+
+        removed = [t for t in current if t.pk not in new_pks]
+        added = [t for t in tag_objs if t.pk not in current_pks]
+        if removed:
+            self._unlink(removed, using)
+        if added:
+            self._link(added, using)
+        return added, removed
 
     @require_instance_manager
+    @refreshes_similar_items
     def remove(self, *tags):
-        self.through.objects.filter(**self._lookup_kwargs()).filter(
-            tag__name__in=tags).delete()
+        self._delete_links(self.through.objects.using(self._db_for_write()).filter(
+            **self._lookup_kwargs()).filter(tag__name__in=tags))
 
     @require_instance_manager
+    @refreshes_similar_items
     def clear(self):
-        self.through.objects.filter(**self._lookup_kwargs()).delete()
+        self._delete_links(self.through.objects.using(self._db_for_write()).filter(
+            **self._lookup_kwargs()))
 
     def most_common(self):
+        tag_model = self.through.tag_model()
+        if counts_enabled(tag_model):
+            content_type_id = self._content_type_id(
+                self.model if self.instance is None else self.instance)
+            if self.instance is None and usage_counts_enabled():
+                qs = tagged_with_counts(tag_model, content_type_id).using(
+                    self._db_for_read(tag_model))
+            else:
+                qs = self.get_queryset()
+            return with_counts(qs, content_type_id)
         return self.get_queryset().annotate(
             num_times=models.Count(self.through.tag_relname())
         ).order_by('-num_times')
 
     @require_instance_manager
-    def similar_objects(self):
+    def similar_objects(self, limit=None, offset=0, queryset=None,
+                        min_shared=1):
+        """
+        Returns the objects sharing the most tags with this one, most similar
+        first. The ranking and paging is done by a single query on the
+        through table, only the objects on the requested page are loaded.
+
+        Pages within the precomputed similar objects are read from the
+        ``SimilarItem`` table instead if ``TAGGIT_SIMILAR_ITEMS`` is enabled.
+        """
         lookup_kwargs = self._lookup_kwargs()
         lookup_keys = sorted(lookup_kwargs)
-        qs = self.through.objects.values(*six.iterkeys(lookup_kwargs))
+        if (limit is not None and queryset is None and min_shared <= 1 and
+                offset + limit <= similar_items_limit() and
+                similar_items_enabled(self.through)):
+            rows = []
+            for ct, pk, score in stored_similar(
+                    self.through, self.instance, offset, limit,
+                    self._db_for_read(SimilarItem)):
+                if len(lookup_keys) == 1:
+                    row = {'content_object': pk}
+                else:
+                    row = {'content_type': ct, 'object_id': pk}
+                row['n'] = score
+                rows.append(row)
+            return self._similar_results(rows, lookup_keys, queryset)
+
+        rows = self.through.objects.using(self._db_for_read())
+        qs = rows.values(*lookup_keys)
         qs = qs.annotate(n=models.Count('pk'))
         qs = qs.exclude(**lookup_kwargs)
-        qs = qs.filter(tag__in=self.all())
-        qs = qs.order_by('-n')
-
-        # TODO: This all feels like a bit of a hack.
+        qs = qs.filter(tag__in=rows.filter(**lookup_kwargs).values('tag'))
+        if queryset is not None:
+            if issubclass(self.through, GenericTaggedItemBase):
+                qs = qs.filter(
+                    content_type=ContentType.objects.get_for_model(queryset.model),
+                    object_id__in=queryset.values('pk'),
+                )
+            else:
+                qs = qs.filter(content_object__in=queryset)
+        if min_shared > 1:
+            qs = qs.filter(n__gte=min_shared)
+        qs = qs.order_by('-n', *lookup_keys)
+        if limit is not None:
+            qs = qs[offset:offset + limit]
+        elif offset:
+            qs = qs[offset:]
+        return self._similar_results(list(qs), lookup_keys, queryset)
+
+    def _similar_results(self, rows, lookup_keys, queryset):
         items = {}
         if len(lookup_keys) == 1:
             # Can we do this without a second query by using a select_related()
             # somehow?
             f = self.through._meta.get_field_by_name(lookup_keys[0])[0]
-            objs = f.rel.to._default_manager.filter(**{
-                "%s__in" % f.rel.field_name: [r["content_object"] for r in qs]
+            if queryset is None:
+                queryset = f.rel.to._default_manager.all()
+            objs = queryset.filter(**{
+                "%s__in" % f.rel.field_name: [r["content_object"] for r in rows]
             })
             for obj in objs:
                 items[(getattr(obj, f.rel.field_name),)] = obj
         else:
             preload = {}
-            for result in qs:
+            for result in rows:
                 preload.setdefault(result['content_type'], set())
                 preload[result["content_type"]].add(result["object_id"])
 
             for ct, obj_ids in preload.items():
                 ct = ContentType.objects.get_for_id(ct)
-                for obj in ct.model_class()._default_manager.filter(pk__in=obj_ids):
+                if queryset is not None:
+                    objs = queryset.filter(pk__in=obj_ids)
+                else:
+                    objs = ct.model_class()._default_manager.filter(pk__in=obj_ids)
+                for obj in objs:
                     items[(ct.pk, obj.pk)] = obj
 
         results = []
-        for result in qs:
-            obj = items[
-                tuple(result[k] for k in lookup_keys)
-            ]
+        for result in rows:
+            # The object may have been deleted without its tags.
+            obj = items.get(tuple(result[k] for k in lookup_keys))
+            if obj is None:
+                continue
             obj.similar_tags = result["n"]
             results.append(obj)
         return results
@@ -227,6 +846,7 @@ class TaggableManager(RelatedField, Field):
         self.rel = TaggableRel(self, related_name, self.through)
         self.swappable = False
         self.manager = manager
+        self.clear_cache()
         # NOTE: `to` is ignored, only used via `deconstruct`.
 
     def __get__(self, instance, model):
@@ -302,6 +922,43 @@ class TaggableManager(RelatedField, Field):
                 raise ValueError('You can\'t have two TaggableManagers with the'
                                  ' same through model.')
 
+        pre_delete.connect(self._clear_deleted, sender=cls, weak=False)
+        _taggable_fields.append(self)
+
+    def _clear_deleted(self, sender, instance, using=None, **kwargs):
+        # The links of a deleted object are removed by the cascade, behind
+        # the back of the tag manager. Removing them through it first keeps
+        # the counts right.
+        if not counts_enabled(self.through.tag_model()):
+            return
+        manager = getattr(instance, self.name)
+        manager._delete_links(self.through.objects.using(using).filter(
+            **manager._lookup_kwargs()))
+
+    def _get_subclasses(self):
+        if self._subclasses is None:
+            self._subclasses = _get_subclasses(self.model)
+        return self._subclasses
+
+    def _get_content_type_ids(self):
+        """
+        Returns a tuple with the ids of the content types of the model and its
+        multi-table inheritance subclasses.
+        """
+        if self._content_type_ids is None:
+            get = ContentType.objects.get_for_model
+            self._content_type_ids = tuple(
+                get(subclass).pk for subclass in self._get_subclasses()
+            )
+        return self._content_type_ids
+
+    def clear_cache(self):
+        """
+        Forgets the subclasses and content type ids computed for the model.
+        """
+        self._subclasses = None
+        self._content_type_ids = None
+
     def save_form_data(self, instance, value):
         getattr(instance, self.name).set(*value)
 
@@ -315,9 +972,12 @@ class TaggableManager(RelatedField, Field):
         return form_class(**defaults)
 
     def value_from_object(self, instance):
+        """
+        Returns the tags of ``instance``, from the prefetched ones if any.
+        """
         if instance.pk:
-            return self.through.objects.filter(**self.through.lookup_kwargs(instance))
-        return self.through.objects.none()
+            return getattr(instance, self.name).all()
+        return self.through.tag_model().objects.none()
 
     def related_query_name(self):
         return _model_name(self.model)
@@ -352,8 +1012,7 @@ class TaggableManager(RelatedField, Field):
         if negate or not self.use_gfk:
             return []
         prefix = "__".join(["tagged_items"] + pieces[:pos-2])
-        get = ContentType.objects.get_for_model
-        cts = [get(obj) for obj in _get_subclasses(self.model)]
+        cts = self._get_content_type_ids()
         if len(cts) == 1:
             return [("%s__content_type" % prefix, cts[0])]
         return [("%s__content_type__in" % prefix, cts)]
@@ -365,14 +1024,14 @@ class TaggableManager(RelatedField, Field):
         else:
             alias_to_join = lhs_alias
         extra_col = self.through._meta.get_field_by_name('content_type')[0].column
-        content_type_ids = [ContentType.objects.get_for_model(subclass).pk for subclass in _get_subclasses(self.model)]
+        content_type_ids = self._get_content_type_ids()
         if len(content_type_ids) == 1:
             content_type_id = content_type_ids[0]
             extra_where = " AND %s.%s = %%s" % (qn(alias_to_join), qn(extra_col))
             params = [content_type_id]
         else:
             extra_where = " AND %s.%s IN (%s)" % (qn(alias_to_join), qn(extra_col), ','.join(['%s']*len(content_type_ids)))
-            params = content_type_ids
+            params = list(content_type_ids)
         return extra_where, params
 
     # This and all the methods till the end of class are only used in django >= 1.6
@@ -426,9 +1085,8 @@ class TaggableManager(RelatedField, Field):
 
     def get_extra_restriction(self, where_class, alias, related_alias):
         extra_col = self.through._meta.get_field_by_name('content_type')[0].column
-        content_type_ids = [ContentType.objects.get_for_model(subclass).pk
-                            for subclass in _get_subclasses(self.model)]
-        return ExtraJoinRestriction(related_alias, extra_col, content_type_ids)
+        return ExtraJoinRestriction(related_alias, extra_col,
+                                    list(self._get_content_type_ids()))
 
     def get_reverse_joining_columns(self):
         return self.get_joining_columns(reverse_join=True)
@@ -443,6 +1101,62 @@ class TaggableManager(RelatedField, Field):
         return [self.related_fields[0][1]]
 
 
+class TaggableQuerySet(QuerySet):
+    """
+    A ``QuerySet`` adding ``filter_tags()`` to models with a
+    ``TaggableManager``.
+    """
+    def filter_tags(self, all=(), any=(), none=(), field=None):
+        """
+        Filters by tags like ``_TaggableManager.filter_tags()``. ``field`` is
+        the name of the ``TaggableManager`` to use if the model has several.
+        """
+        fields = [
+            f for f in self.model._meta.many_to_many
+            if isinstance(f, TaggableManager) and field in (None, f.name)
+        ]
+        if len(fields) != 1:
+            raise ValueError("%s has %d matching tag fields, expected exactly "
+                "one." % (self.model.__name__, len(fields)))
+        manager = getattr(self.model, fields[0].name)
+        return manager.filter_tags(self, all=all, any=any, none=none)
+
+
+def _bulk_create(model, objs, using):
+    # bulk_create() refuses to work on proxy models, but the rows are stored
+    # in the table of the concrete model anyway.
+    if objs:
+        model._meta.concrete_model._default_manager.using(using).bulk_create(objs)
+
+
+def _cached_tag(tag_model, pk, name):
+    # Everything but the primary key and the name is loaded on access.
+    deferred = [f.attname for f in tag_model._meta.fields
+                if f.attname not in (tag_model._meta.pk.attname, 'name')]
+    return deferred_class_factory(tag_model, deferred)(pk=pk, name=name)
+
+
+def _object_field(through):
+    """
+    Returns the field of ``through`` which holds the tagged object's key.
+    """
+    fieldname = ('object_id' if issubclass(through, GenericTaggedItemBase)
+                 else 'content_object')
+    return through._meta.get_field(fieldname)
+
+
+# All the concrete TaggableManager fields, their cached content type ids are
+# dropped whenever the content types might have been recreated.
+_taggable_fields = []
+
+
+def _clear_caches(**kwargs):
+    for field in _taggable_fields:
+        field.clear_cache()
+
+post_migrate.connect(_clear_caches)
+
+
 def _get_subclasses(model):
     subclasses = [model]
     for f in model._meta.get_all_field_names():
@@ -0,0 +1,36 @@
+# encoding: utf8
+from django.db import models, migrations
+
+
+def remove_duplicates(apps, schema_editor):
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    duplicates = TaggedItem.objects.values(
+        'content_type', 'object_id', 'tag'
+    ).annotate(
+        min_id=models.Min('id'), n=models.Count('id')
+    ).filter(n__gt=1)
+    for row in duplicates:
+        TaggedItem.objects.filter(
+            content_type=row['content_type'],
+            object_id=row['object_id'],
+            tag=row['tag'],
+        ).exclude(id=row['min_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taggit', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates),
+        migrations.AlterUniqueTogether(
+            name='taggeditem',
+            unique_together=set([('content_type', 'object_id', 'tag')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='taggeditem',
+            index_together=set([('tag', 'content_type', 'object_id')]),
+        ),
+    ]
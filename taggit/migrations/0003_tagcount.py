@@ -0,0 +1,30 @@
+# encoding: utf8
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '__first__'),
+        ('taggit', '0002_taggeditem_unique_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagCount',
+            fields=[
+                (u'id', models.AutoField(verbose_name=u'ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_type', models.ForeignKey(related_name=u'+', verbose_name=u'Content type', to='contenttypes.ContentType')),
+                ('tag_type', models.ForeignKey(related_name=u'+', verbose_name=u'Tag type', to='contenttypes.ContentType')),
+                ('tag_id', models.IntegerField(verbose_name=u'Tag id')),
+                ('shard', models.PositiveSmallIntegerField(default=0, verbose_name=u'Shard')),
+                ('count', models.IntegerField(default=0, verbose_name=u'Count')),
+            ],
+            options={
+                u'verbose_name': u'Tag count',
+                u'verbose_name_plural': u'Tag counts',
+                u'unique_together': set([('content_type', 'tag_type', 'tag_id', 'shard')]),
+            },
+            bases=(models.Model,),
+        ),
+    ]
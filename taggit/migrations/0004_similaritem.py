@@ -0,0 +1,32 @@
+# encoding: utf8
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '__first__'),
+        ('taggit', '0003_tagcount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarItem',
+            fields=[
+                (u'id', models.AutoField(verbose_name=u'ID', serialize=False, auto_created=True, primary_key=True)),
+                ('through_type', models.ForeignKey(related_name=u'+', verbose_name=u'Through type', to='contenttypes.ContentType')),
+                ('content_type', models.ForeignKey(related_name=u'+', verbose_name=u'Content type', to='contenttypes.ContentType')),
+                ('object_id', models.IntegerField(verbose_name=u'Object id')),
+                ('similar_content_type', models.ForeignKey(related_name=u'+', verbose_name=u'Similar content type', to='contenttypes.ContentType')),
+                ('similar_object_id', models.IntegerField(verbose_name=u'Similar object id')),
+                ('score', models.PositiveIntegerField(verbose_name=u'Score')),
+            ],
+            options={
+                u'verbose_name': u'Similar item',
+                u'verbose_name_plural': u'Similar items',
+                u'unique_together': set([('through_type', 'content_type', 'object_id', 'similar_content_type', 'similar_object_id')]),
+                u'index_together': set([('through_type', 'similar_content_type', 'similar_object_id')]),
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -1,16 +1,25 @@
 from __future__ import unicode_literals
 
+import time
+
+from django import VERSION
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 try:
     from django.contrib.contenttypes.fields import GenericForeignKey
 except ImportError:  # django < 1.7
     from django.contrib.contenttypes.generic import GenericForeignKey
-from django.db import models, IntegrityError, transaction
+from django.db import connections, models, router, IntegrityError, transaction
 from django.db.models.query import QuerySet
+from django.db.models.signals import class_prepared, post_save, post_delete
 from pytils.translit import slugify as default_slugify
 from django.utils.translation import ugettext_lazy as _, ugettext
 from django.utils.encoding import python_2_unicode_compatible
 
+from taggit.cache import invalidate_tag
+from taggit.instance_cache import new_generation
+from taggit.utils import iter_chunks
+
 
 try:
     atomic = transaction.atomic
@@ -29,11 +38,180 @@ except AttributeError:
             transaction.savepoint_commit(sid, using=using)
 
 
+def _bulk_insert_ignore(model, objs, using):
+    """
+    Inserts ``objs``, skipping the rows which would violate a unique
+    constraint instead of raising ``IntegrityError``. Returns ``False`` if the
+    database doesn't support that.
+    """
+    connection = connections[using]
+    opts = model._meta.concrete_model._meta
+    qn = connection.ops.quote_name
+    if connection.vendor == 'sqlite':
+        template = "INSERT OR IGNORE INTO %s (%s) %s"
+    elif connection.vendor == 'mysql':
+        # Unlike INSERT IGNORE, which also drops the rows with invalid
+        # foreign keys or values, this only skips duplicates.
+        pk = qn(opts.pk.column)
+        template = ("INSERT INTO %%s (%%s) %%s ON DUPLICATE KEY UPDATE %s = %s"
+                    % (pk, pk))
+    elif connection.vendor == 'postgresql' and connection.pg_version >= 90500:
+        template = "INSERT INTO %s (%s) %s ON CONFLICT DO NOTHING"
+    else:
+        return False
+
+    fields = [f for f in opts.local_fields
+              if not isinstance(f, models.AutoField)]
+    columns = ", ".join(qn(f.column) for f in fields)
+    cursor = connection.cursor()
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+    for chunk in iter_chunks(objs, batch_size):
+        params = [
+            f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+            for obj in chunk
+            for f in fields
+        ]
+        cursor.execute(template % (
+            qn(opts.db_table), columns,
+            connection.ops.bulk_insert_sql(fields, len(chunk))
+        ), params)
+    if VERSION < (1, 6):
+        transaction.commit_unless_managed(using=using)
+    return True
+
+
+def connect_tag_cache(sender, **kwargs):
+    if issubclass(sender, TagBase) and not getattr(sender, '_deferred', False):
+        post_save.connect(invalidate_tag, sender=sender)
+        post_delete.connect(invalidate_tag, sender=sender)
+        post_save.connect(new_generation, sender=sender)
+        post_delete.connect(new_generation, sender=sender)
+
+class_prepared.connect(connect_tag_cache)
+
+
+# Stands in for the index in slugs to find where slugify() puts it.
+_SLUG_MARKER = 9876543210
+
+
+def _regex_escape(value):
+    return ''.join('\\' + c if c in '\\.^$*+?{}[]|()' else c for c in value)
+
+
+class TagManager(models.Manager):
+    def merge(self, target, *sources):
+        """
+        Moves everything tagged with the ``sources`` tags to ``target`` and
+        deletes the ``sources``.
+
+        Every through model of the tag model gets one ``UPDATE`` repointing
+        its rows, after one ``DELETE`` of the rows which would become
+        duplicates. Denormalized counts and precomputed similar objects are
+        updated, all in one transaction.
+        """
+        from taggit.counts import counts_enabled, update_counts
+        from taggit.similar import (similar_items_enabled, object_keys,
+            refresh_similar_items)
+
+        source_pks = [s.pk for s in sources if s.pk != target.pk]
+        if not source_pks:
+            return target
+        tag_model = self.model
+        using = router.db_for_write(tag_model, instance=target)
+        counting = counts_enabled(tag_model)
+        with atomic(using=using):
+            for through in get_through_models(tag_model):
+                rows = through._default_manager.using(using)
+                moved = rows.filter(tag__in=source_pks)
+                similar_keys = None
+                if similar_items_enabled(through):
+                    similar_keys = object_keys(through, moved)
+                if counting:
+                    before = _count_by_content_type(through, rows, target.pk)
+                _delete_merge_duplicates(through, target.pk, source_pks, using)
+                moved.update(tag=target.pk)
+                if counting:
+                    after = _count_by_content_type(through, rows, target.pk)
+                    update_counts(tag_model, dict(
+                        ((ct, target.pk), n - before.get(ct, 0))
+                        for ct, n in after.items()
+                    ), using)
+                if similar_keys:
+                    refresh_similar_items(through, similar_keys, using)
+            TagCount.objects.using(using).filter(
+                tag_type=ContentType.objects.get_for_model(tag_model),
+                tag_id__in=source_pks,
+            ).delete()
+            self.using(using).filter(pk__in=source_pks).delete()
+        return target
+
+    def purge(self, *tags):
+        """
+        Deletes ``tags`` along with everything tagged with them, using one
+        ``DELETE`` per through model. Precomputed similar objects are updated,
+        all in one transaction. Returns the number of deleted through rows.
+        """
+        from taggit.similar import (similar_items_enabled, object_keys,
+            refresh_similar_items)
+
+        pks = [tag.pk for tag in tags]
+        if not pks:
+            return 0
+        tag_model = self.model
+        using = router.db_for_write(tag_model)
+        deleted = 0
+        with atomic(using=using):
+            for through in get_through_models(tag_model):
+                rows = through._default_manager.using(using).filter(tag__in=pks)
+                similar_keys = None
+                if similar_items_enabled(through):
+                    similar_keys = object_keys(through, rows)
+                deleted += rows.count()
+                rows.delete()
+                if similar_keys:
+                    refresh_similar_items(through, similar_keys, using)
+            TagCount.objects.using(using).filter(
+                tag_type=ContentType.objects.get_for_model(tag_model),
+                tag_id__in=pks,
+            ).delete()
+            self.using(using).filter(pk__in=pks).delete()
+        return deleted
+
+    def orphans(self):
+        """
+        Returns the tags which aren't used by any through model.
+        """
+        if hasattr(self, 'get_queryset'):
+            qs = self.get_queryset()
+        else:  # django < 1.6
+            qs = self.get_query_set()
+        return orphan_tags(qs)
+
+    def prune(self, batch_size=1000, sleep=0, progress=None):
+        """
+        Deletes the unused tags, see ``prune_tags()``.
+        """
+        return prune_tags(self.model, batch_size, sleep, progress)
+
+    def autocomplete(self, prefix, limit=10):
+        """
+        Returns up to ``limit`` tags whose name starts with ``prefix``, most
+        used first, see ``taggit.autocomplete``.
+        """
+        from taggit.autocomplete import autocomplete
+        return autocomplete(self.model, prefix, limit)
+
+
 @python_2_unicode_compatible
 class TagBase(models.Model):
     name = models.CharField(verbose_name=_('Name'), unique=True, max_length=100)
     slug = models.SlugField(verbose_name=_('Slug'), unique=True, max_length=100)
 
+    objects = TagManager()
+
+    # How many suffixed slugs save() tries before giving up.
+    slug_attempts = 5
+
     def __str__(self):
         return self.name
 
@@ -54,7 +232,6 @@ class TagBase(models.Model):
             #     self.name = reuse[0].name
             #     return super(TagBase, self).save(*args, **kwargs)
             self.slug = self.slugify(self.name)
-            from django.db import router
             using = kwargs.get("using") or router.db_for_write(
                 type(self), instance=self)
             # Make sure we write to the same db for all attempted writes,
@@ -69,18 +246,19 @@ class TagBase(models.Model):
                 return res
             except IntegrityError:
                 pass
-            # Now try to find existing slugs with similar names
-            slugs = set(Tag.objects.filter(slug__startswith=self.slug)\
-                                   .values_list('slug', flat=True))
-            i = 1
-            while True:
-                slug = self.slugify(self.name, i)
-                if slug not in slugs:
-                    self.slug = slug
-                    # We purposely ignore concurrecny issues here for now.
-                    # (That is, till we found a nice solution...)
-                    return super(TagBase, self).save(*args, **kwargs)
-                i += 1
+            # Now take the suffix after the highest one in use. Another
+            # process may take the same slug first, in which case we try
+            # again with the next one.
+            i = 0
+            for attempt in range(self.slug_attempts):
+                i = max(i + 1, self.next_slug_index(using))
+                self.slug = self.slugify(self.name, i)
+                try:
+                    with atomic(using=using):
+                        return super(TagBase, self).save(*args, **kwargs)
+                except IntegrityError:
+                    if attempt == self.slug_attempts - 1:
+                        raise
         else:
             return super(TagBase, self).save(*args, **kwargs)
 
@@ -90,6 +268,39 @@ class TagBase(models.Model):
             slug += "_%d" % i
         return slug
 
+    def next_slug_index(self, using=None, name=None):
+        """
+        Returns the index after the highest one used in the slugs of the
+        ``name`` (by default this tag's name) tags, with a single query
+        against the prefix of the slugs.
+        """
+        if name is None:
+            name = self.name
+        marker = '%d' % _SLUG_MARKER
+        template = self.slugify(name, _SLUG_MARKER)
+        pos = template.rfind(marker)
+        if pos == -1:
+            # slugify() doesn't use the index, there is nothing to look for.
+            return 1
+        prefix, suffix = template[:pos], template[pos + len(marker):]
+
+        using = using or router.db_for_read(type(self))
+        qn = connections[using].ops.quote_name
+        column = qn(self._meta.get_field('slug').column)
+        slugs = type(self)._default_manager.using(using).filter(
+            slug__startswith=prefix,
+            slug__regex='^%s[0-9]+%s$' % (_regex_escape(prefix),
+                                          _regex_escape(suffix)),
+        ).extra(
+            # Longer numbers are higher, numbers of the same length compare
+            # like strings.
+            select={'slug_length': 'LENGTH(%s)' % column},
+            order_by=['-slug_length', '-slug'],
+        ).values_list('slug', 'slug_length')[:1]
+        for slug, length in slugs:
+            return int(slug[len(prefix):len(slug) - len(suffix)]) + 1
+        return 1
+
 
 class Tag(TagBase):
     class Meta:
@@ -157,6 +368,13 @@ class GenericTaggedItemBase(ItemBase):
 
     class Meta:
         abstract=True
+        # Covers the lookups of the tags of an object and makes sure an
+        # object can't be tagged twice with the same tag.
+        unique_together = (('content_type', 'object_id', 'tag'),)
+        if VERSION >= (1, 5):
+            # Covers the lookups of the objects tagged with a tag, in the
+            # order of their ids.
+            index_together = [('tag', 'content_type', 'object_id')]
 
     @classmethod
     def lookup_kwargs(cls, instance):
@@ -174,10 +392,13 @@ class GenericTaggedItemBase(ItemBase):
                 "content_type": ContentType.objects.get_for_model(instances.model),
             }
         else:
-            # TODO: instances[0], can we assume there are instances.
+            models_ = set(instance._meta.concrete_model for instance in instances)
+            if len(models_) != 1:
+                raise ValueError("bulk_lookup_kwargs() takes instances of a "
+                                 "single model, got %d models." % len(models_))
             return {
                 "object_id__in": [instance.pk for instance in instances],
-                "content_type": ContentType.objects.get_for_model(instances[0]),
+                "content_type": ContentType.objects.get_for_model(models_.pop()),
             }
 
     @classmethod
@@ -192,6 +413,191 @@ class GenericTaggedItemBase(ItemBase):
 
 
 class TaggedItem(GenericTaggedItemBase, TaggedItemBase):
-    class Meta:
+    class Meta(GenericTaggedItemBase.Meta):
         verbose_name = _("Tagged Item")
         verbose_name_plural = _("Tagged Items")
+
+
+class TagCount(models.Model):
+    """
+    How many times a tag is used on a model. The counts of hot tags can be
+    spread over several rows (shards) to reduce lock contention, the total is
+    the sum of all shards.
+    """
+    content_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Content type'),
+        related_name='+'
+    )
+    tag_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Tag type'),
+        related_name='+'
+    )
+    tag_id = models.IntegerField(verbose_name=_('Tag id'))
+    shard = models.PositiveSmallIntegerField(verbose_name=_('Shard'), default=0)
+    count = models.IntegerField(verbose_name=_('Count'), default=0)
+
+    class Meta:
+        verbose_name = _("Tag count")
+        verbose_name_plural = _("Tag counts")
+        unique_together = (('content_type', 'tag_type', 'tag_id', 'shard'),)
+
+
+class SimilarItem(models.Model):
+    """
+    A precomputed similar object: ``score`` is the number of tags the
+    objects share through the ``through_type`` through model.
+    """
+    through_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Through type'),
+        related_name='+'
+    )
+    content_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Content type'),
+        related_name='+'
+    )
+    object_id = models.IntegerField(verbose_name=_('Object id'))
+    similar_content_type = models.ForeignKey(
+        ContentType,
+        verbose_name=_('Similar content type'),
+        related_name='+'
+    )
+    similar_object_id = models.IntegerField(verbose_name=_('Similar object id'))
+    score = models.PositiveIntegerField(verbose_name=_('Score'))
+
+    class Meta:
+        verbose_name = _("Similar item")
+        verbose_name_plural = _("Similar items")
+        unique_together = (('through_type', 'content_type', 'object_id',
+                            'similar_content_type', 'similar_object_id'),)
+        if VERSION >= (1, 5):
+            index_together = [('through_type', 'similar_content_type',
+                               'similar_object_id')]
+
+
+def get_through_models(tag_model=None):
+    """
+    Returns the concrete through models, optionally only those linking to
+    ``tag_model``.
+    """
+    try:
+        from django.apps import apps
+        get_models = apps.get_models
+    except ImportError:  # django < 1.7
+        from django.db.models import get_models
+    return [
+        m for m in get_models()
+        if issubclass(m, ItemBase) and not m._meta.proxy and (
+            tag_model is None or
+            m.tag_model()._meta.concrete_model == tag_model._meta.concrete_model
+        )
+    ]
+
+
+def _count_by_content_type(through, rows, tag_pk):
+    rows = rows.filter(tag=tag_pk)
+    if issubclass(through, GenericTaggedItemBase):
+        return dict(rows.values_list('content_type').annotate(
+            n=models.Count('pk')).order_by())
+    model = through._meta.get_field('content_object').rel.to
+    return {ContentType.objects.get_for_model(model).pk: rows.count()}
+
+
+def _delete_merge_duplicates(through, target_pk, source_pks, using):
+    """
+    Deletes the rows of ``source_pks`` tags on objects which are also tagged
+    with ``target_pk``, or with a source tag of lower primary key, with a
+    single anti-join.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = through._meta
+    table = qn(opts.db_table)
+    tag = qn(opts.get_field('tag').column)
+    if issubclass(through, GenericTaggedItemBase):
+        columns = [qn(opts.get_field('content_type').column),
+                   qn(opts.get_field('object_id').column)]
+    else:
+        columns = [qn(opts.get_field('content_object').column)]
+    same_object = ' AND '.join('dup.%s = %s.%s' % (c, table, c) for c in columns)
+    placeholders = ', '.join(['%s'] * len(source_pks))
+    duplicate = (
+        "(dup.%(tag)s = %%s OR (dup.%(tag)s IN (%(pks)s) AND "
+        "dup.%(tag)s < %(table)s.%(tag)s))"
+    ) % {'tag': tag, 'pks': placeholders, 'table': table}
+    if connection.vendor == 'mysql':
+        # MySQL can't use the table being deleted from in a subquery.
+        sql = ("DELETE %(table)s FROM %(table)s INNER JOIN %(table)s dup ON "
+               "%(same)s WHERE %(table)s.%(tag)s IN (%(pks)s) AND %(dup)s")
+    else:
+        sql = ("DELETE FROM %(table)s WHERE %(table)s.%(tag)s IN (%(pks)s) AND "
+               "EXISTS (SELECT 1 FROM %(table)s dup WHERE %(same)s AND %(dup)s)")
+    sql = sql % {'table': table, 'tag': tag, 'pks': placeholders,
+                 'same': same_object, 'dup': duplicate}
+    params = list(source_pks) + [target_pk] + list(source_pks)
+    connection.cursor().execute(sql, params)
+
+
+def delete_orphans_enabled():
+    return getattr(settings, 'TAGGIT_DELETE_ORPHANS', False)
+
+
+def orphan_tags(qs):
+    """
+    Restricts the tag queryset ``qs`` to the tags which aren't used by any
+    through model, with one anti-join per through model.
+    """
+    for through in get_through_models(qs.model):
+        qs = qs.exclude(pk__in=through._default_manager.values('tag'))
+    return qs
+
+
+def prune_tags(tag_model, batch_size=1000, sleep=0, progress=None):
+    """
+    Deletes the unused ``tag_model`` tags in batches of ``batch_size``,
+    sleeping ``sleep`` seconds between batches to spread the load.
+    ``progress`` is called with the number of tags deleted so far after each
+    batch. Returns the number of deleted tags.
+    """
+    deleted = 0
+    last = None
+    while True:
+        # Paging by key keeps each batch from scanning the tags before it
+        # again, including those a batch didn't delete.
+        qs = tag_model._default_manager.all()
+        if last is not None:
+            qs = qs.filter(pk__gt=last)
+        pks = list(orphan_tags(qs).order_by('pk').values_list(
+            'pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += delete_orphan_tags(tag_model, pks)
+        if progress is not None:
+            progress(deleted)
+        if len(pks) < batch_size:
+            return deleted
+        last = pks[-1]
+        time.sleep(sleep)
+
+
+def delete_orphan_tags(tag_model, pks, using=None):
+    """
+    Deletes the tags among ``pks`` which are unused, along with their
+    counts. Returns the number of deleted tags.
+    """
+    using = using or router.db_for_write(tag_model)
+    with atomic(using=using):
+        # Checked again here as the tags may have been used meanwhile.
+        pks = list(orphan_tags(tag_model._default_manager.using(using).filter(
+            pk__in=pks)).values_list('pk', flat=True))
+        if not pks:
+            return 0
+        TagCount.objects.using(using).filter(
+            tag_type=ContentType.objects.get_for_model(tag_model),
+            tag_id__in=pks,
+        ).delete()
+        tag_model._default_manager.using(using).filter(pk__in=pks).delete()
+    return len(pks)
@@ -0,0 +1,284 @@
+"""
+Precomputed similar objects.
+
+If the ``TAGGIT_SIMILAR_ITEMS`` setting is ``True``, the ``SimilarItem`` table
+holds the ``TAGGIT_SIMILAR_ITEMS_LIMIT`` (20 by default) most similar objects
+of every tagged object. The tag managers recompute the objects whose tags
+they change, and ``similar_objects()`` reads from the table.
+
+Objects only sharing tags with a changed object are updated by adding or
+removing the changed object from their similar objects, without being
+recomputed, so their lists can drift a bit from the exact ranking. The
+``taggit_rebuild_similar`` command recomputes the whole table.
+"""
+from __future__ import unicode_literals
+
+import heapq
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, models, router, IntegrityError
+from django.utils.functional import wraps
+
+from taggit.models import (SimilarItem, GenericTaggedItemBase, atomic,
+    _bulk_insert_ignore)
+from taggit.utils import iter_chunks
+
+
+def similar_items_enabled(through):
+    if not getattr(settings, 'TAGGIT_SIMILAR_ITEMS', False):
+        return False
+    if issubclass(through, GenericTaggedItemBase):
+        return True
+    # The table only holds integer object ids.
+    pk = through._meta.get_field('content_object').rel.to._meta.pk
+    return isinstance(pk, (models.AutoField, models.IntegerField))
+
+
+def similar_items_limit():
+    return getattr(settings, 'TAGGIT_SIMILAR_ITEMS_LIMIT', 20)
+
+
+def object_key(through, obj):
+    """
+    Returns the ``(content_type_id, object_id)`` pair ``obj`` is stored
+    under.
+    """
+    if issubclass(through, GenericTaggedItemBase):
+        return (ContentType.objects.get_for_model(obj).pk, obj.pk)
+    return (_fk_content_type_id(through), obj.pk)
+
+
+def object_keys(through, qs):
+    """
+    Returns the keys of the objects tagged by the through rows in ``qs``.
+    """
+    if issubclass(through, GenericTaggedItemBase):
+        return set(qs.values_list('content_type', 'object_id').distinct())
+    ct = _fk_content_type_id(through)
+    return set(
+        (ct, pk) for pk in
+        qs.values_list('content_object', flat=True).distinct()
+    )
+
+
+def stored_similar(through, obj, offset=0, limit=None, using=None):
+    """
+    Returns the stored similar objects of ``obj`` as ``(content_type_id,
+    object_id, score)`` tuples, most similar first.
+    """
+    ct, pk = object_key(through, obj)
+    qs = SimilarItem.objects.using(using).filter(
+        through_type=ContentType.objects.get_for_model(through),
+        content_type=ct,
+        object_id=pk,
+    ).order_by(
+        '-score', 'similar_content_type', 'similar_object_id'
+    ).values_list('similar_content_type', 'similar_object_id', 'score')
+    if limit is None:
+        limit = similar_items_limit() - offset
+    return list(qs[offset:offset + limit])
+
+
+def refreshes_similar_items(func):
+    """
+    Decorates the write methods of the tag managers, collecting the objects
+    whose links change in ``self._similar_keys`` and recomputing their similar
+    objects once the outermost call is done.
+    """
+    @wraps(func)
+    def inner(self, *args, **kwargs):
+        if (getattr(self, '_similar_keys', None) is not None or
+                not similar_items_enabled(self.through)):
+            return func(self, *args, **kwargs)
+        self._similar_keys = set()
+        try:
+            result = func(self, *args, **kwargs)
+            keys = self._similar_keys
+        finally:
+            self._similar_keys = None
+        if keys:
+            refresh_similar_items(self.through, keys, self._db_for_write())
+        return result
+    return inner
+
+
+def refresh_similar_items(through, keys, using=None):
+    """
+    Recomputes the similar objects of the objects with the given ``keys``
+    from the through rows on the ``using`` database, in one transaction.
+    """
+    using = using or router.db_for_write(through)
+    with atomic(using=using):
+        _refresh(through, set(keys), using)
+
+
+def _refresh(through, keys, using):
+    through_type = ContentType.objects.get_for_model(through)
+    limit = similar_items_limit()
+    items = SimilarItem.objects.using(using).filter(through_type=through_type)
+    for ct, ids in _group_keys(keys).items():
+        for chunk in iter_chunks(ids, 500):
+            items.filter(content_type=ct, object_id__in=chunk).delete()
+            items.filter(similar_content_type=ct,
+                         similar_object_id__in=chunk).delete()
+
+    # Read from the database just written to, a replica could lag behind.
+    forward = _compute(through, keys, limit, using)
+    _insert(through_type, forward, using)
+
+    # The changed objects may now belong to the similar objects of their
+    # neighbours.
+    reverse = {}
+    for (key, similar, score) in forward:
+        if similar not in keys:
+            reverse.setdefault(similar, []).append((score, key))
+    if not reverse:
+        return
+    stats = {}
+    for ct, ids in _group_keys(reverse).items():
+        for chunk in iter_chunks(ids, 500):
+            for pk, n, low in items.filter(
+                content_type=ct, object_id__in=chunk
+            ).values_list('object_id').annotate(
+                n=models.Count('pk'), low=models.Min('score')
+            ).order_by():
+                stats[(ct, pk)] = (n, low)
+
+    rows = []
+    overflowing = set()
+    for similar, candidates in reverse.items():
+        n, low = stats.get(similar, (0, 0))
+        for score, key in candidates:
+            if n < limit or score > low:
+                rows.append((similar, key, score))
+                n += 1
+        if n > limit:
+            overflowing.add(similar)
+    _insert(through_type, rows, using)
+    _trim(items, overflowing, limit)
+
+
+def rebuild_similar_items(through, batch_size=500, using=None):
+    """
+    Recomputes the similar objects of every object tagged through
+    ``through``.
+    """
+    using = using or router.db_for_write(through)
+    through_type = ContentType.objects.get_for_model(through)
+    SimilarItem.objects.using(using).filter(through_type=through_type).delete()
+    limit = similar_items_limit()
+    keys = object_keys(through, through.objects.using(using))
+    for chunk in iter_chunks(sorted(keys), batch_size):
+        _insert(through_type, _compute(through, chunk, limit, using), using)
+
+
+def _compute(through, keys, limit, using):
+    """
+    Returns ``(key, similar_key, score)`` tuples with the ``limit`` most
+    similar objects of the objects with the given ``keys``, using one
+    self-join on the through table per content type and batch.
+    """
+    qn = connections[using].ops.quote_name
+    opts = through._meta
+    table = qn(opts.db_table)
+    tag = qn(opts.get_field('tag').column)
+    generic = issubclass(through, GenericTaggedItemBase)
+    if generic:
+        ct_col = qn(opts.get_field('content_type').column)
+        obj = qn(opts.get_field('object_id').column)
+    else:
+        obj = qn(opts.get_field('content_object').column)
+
+    scores = {}
+    cursor = connections[using].cursor()
+    for ct, ids in _group_keys(keys).items():
+        for chunk in iter_chunks(ids, 500):
+            placeholders = ', '.join(['%s'] * len(chunk))
+            if generic:
+                sql = (
+                    "SELECT a.%(obj)s, b.%(ct)s, b.%(obj)s, COUNT(*) "
+                    "FROM %(table)s a INNER JOIN %(table)s b "
+                    "ON a.%(tag)s = b.%(tag)s "
+                    "WHERE a.%(ct)s = %%s AND a.%(obj)s IN (%(ids)s) "
+                    "AND NOT (b.%(ct)s = a.%(ct)s AND b.%(obj)s = a.%(obj)s) "
+                    "GROUP BY a.%(obj)s, b.%(ct)s, b.%(obj)s"
+                ) % {'obj': obj, 'ct': ct_col, 'table': table, 'tag': tag,
+                     'ids': placeholders}
+                cursor.execute(sql, [ct] + list(chunk))
+                rows = cursor.fetchall()
+            else:
+                sql = (
+                    "SELECT a.%(obj)s, b.%(obj)s, COUNT(*) "
+                    "FROM %(table)s a INNER JOIN %(table)s b "
+                    "ON a.%(tag)s = b.%(tag)s "
+                    "WHERE a.%(obj)s IN (%(ids)s) AND b.%(obj)s <> a.%(obj)s "
+                    "GROUP BY a.%(obj)s, b.%(obj)s"
+                ) % {'obj': obj, 'table': table, 'tag': tag,
+                     'ids': placeholders}
+                cursor.execute(sql, list(chunk))
+                rows = [(a, ct, b, n) for a, b, n in cursor.fetchall()]
+            for a, similar_ct, b, n in rows:
+                scores.setdefault((ct, a), []).append((-n, (similar_ct, b)))
+
+    result = []
+    for key, candidates in scores.items():
+        for n, similar in heapq.nsmallest(limit, candidates):
+            result.append((key, similar, -n))
+    return result
+
+
+def _insert(through_type, rows, using):
+    # A concurrent refresh of the same objects may have stored some of the
+    # rows already, those are skipped.
+    items = [
+        SimilarItem(
+            through_type_id=through_type.pk,
+            content_type_id=key[0], object_id=key[1],
+            similar_content_type_id=similar[0], similar_object_id=similar[1],
+            score=score,
+        )
+        for key, similar, score in rows
+    ]
+    if not items or _bulk_insert_ignore(SimilarItem, items, using):
+        return
+    try:
+        with atomic(using=using):
+            SimilarItem.objects.using(using).bulk_create(items, batch_size=500)
+    except IntegrityError:
+        for item in items:
+            try:
+                with atomic(using=using):
+                    item.save(using=using, force_insert=True)
+            except IntegrityError:
+                pass
+
+
+def _trim(items, keys, limit):
+    # Drops the least similar objects of the objects having too many.
+    stale = []
+    for ct, ids in _group_keys(keys).items():
+        for chunk in iter_chunks(ids, 500):
+            rows = {}
+            for pk, object_id, score in items.filter(
+                content_type=ct, object_id__in=chunk
+            ).values_list('pk', 'object_id', 'score'):
+                rows.setdefault(object_id, []).append((-score, pk))
+            for candidates in rows.values():
+                candidates.sort()
+                stale.extend(pk for score, pk in candidates[limit:])
+    for chunk in iter_chunks(stale, 500):
+        items.filter(pk__in=chunk).delete()
+
+
+def _group_keys(keys):
+    groups = {}
+    for ct, pk in keys:
+        groups.setdefault(ct, []).append(pk)
+    return groups
+
+
+def _fk_content_type_id(through):
+    return ContentType.objects.get_for_model(
+        through._meta.get_field('content_object').rel.to
+    ).pk
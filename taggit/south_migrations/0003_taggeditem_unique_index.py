@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Removing duplicate 'TaggedItem' rows, keeping the oldest one
+        duplicates = orm['taggit.TaggedItem'].objects.values(
+            'content_type', 'object_id', 'tag'
+        ).annotate(
+            min_id=models.Min('id'), n=models.Count('id')
+        ).filter(n__gt=1)
+        for row in duplicates:
+            orm['taggit.TaggedItem'].objects.filter(
+                content_type=row['content_type'],
+                object_id=row['object_id'],
+                tag=row['tag'],
+            ).exclude(id=row['min_id']).delete()
+
+        # Adding unique constraint on 'TaggedItem', fields ['content_type', 'object_id', 'tag']
+        db.create_unique('taggit_taggeditem', ['content_type_id', 'object_id', 'tag_id'])
+
+        # Adding index on 'TaggedItem', fields ['tag', 'content_type', 'object_id']
+        db.create_index('taggit_taggeditem', ['tag_id', 'content_type_id', 'object_id'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'TaggedItem', fields ['tag', 'content_type', 'object_id']
+        db.delete_index('taggit_taggeditem', ['tag_id', 'content_type_id', 'object_id'])
+
+        # Removing unique constraint on 'TaggedItem', fields ['content_type', 'object_id', 'tag']
+        db.delete_unique('taggit_taggeditem', ['content_type_id', 'object_id', 'tag_id'])
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'taggit.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        'taggit.taggeditem': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'tag'),)", 'object_name': 'TaggedItem', 'index_together': "[('tag', 'content_type', 'object_id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_tagged_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_items'", 'to': "orm['taggit.Tag']"})
+        }
+    }
+
+    complete_apps = ['taggit']
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'SimilarItem'
+        db.create_table('taggit_similaritem', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('through_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['contenttypes.ContentType'])),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['contenttypes.ContentType'])),
+            ('object_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('similar_content_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name='+', to=orm['contenttypes.ContentType'])),
+            ('similar_object_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('score', self.gf('django.db.models.fields.PositiveIntegerField')()),
+        ))
+        db.send_create_signal('taggit', ['SimilarItem'])
+
+        # Adding unique constraint on 'SimilarItem', fields ['through_type', 'content_type', 'object_id', 'similar_content_type', 'similar_object_id']
+        db.create_unique('taggit_similaritem', ['through_type_id', 'content_type_id', 'object_id', 'similar_content_type_id', 'similar_object_id'])
+
+        # Adding index on 'SimilarItem', fields ['through_type', 'similar_content_type', 'similar_object_id']
+        db.create_index('taggit_similaritem', ['through_type_id', 'similar_content_type_id', 'similar_object_id'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'SimilarItem', fields ['through_type', 'similar_content_type', 'similar_object_id']
+        db.delete_index('taggit_similaritem', ['through_type_id', 'similar_content_type_id', 'similar_object_id'])
+
+        # Removing unique constraint on 'SimilarItem', fields ['through_type', 'content_type', 'object_id', 'similar_content_type', 'similar_object_id']
+        db.delete_unique('taggit_similaritem', ['through_type_id', 'content_type_id', 'object_id', 'similar_content_type_id', 'similar_object_id'])
+
+        # Deleting model 'SimilarItem'
+        db.delete_table('taggit_similaritem')
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'taggit.similaritem': {
+            'Meta': {'unique_together': "(('through_type', 'content_type', 'object_id', 'similar_content_type', 'similar_object_id'),)", 'object_name': 'SimilarItem', 'index_together': "[('through_type', 'similar_content_type', 'similar_object_id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {}),
+            'score': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'similar_content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['contenttypes.ContentType']"}),
+            'similar_object_id': ('django.db.models.fields.IntegerField', [], {}),
+            'through_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['contenttypes.ContentType']"})
+        },
+        'taggit.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '100'})
+        },
+        'taggit.tagcount': {
+            'Meta': {'unique_together': "(('content_type', 'tag_type', 'tag_id', 'shard'),)", 'object_name': 'TagCount'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'shard': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'tag_id': ('django.db.models.fields.IntegerField', [], {}),
+            'tag_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['contenttypes.ContentType']"})
+        },
+        'taggit.taggeditem': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'tag'),)", 'object_name': 'TaggedItem', 'index_together': "[('tag', 'content_type', 'object_id')]"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_tagged_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {'db_index': 'True'}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'taggit_taggeditem_items'", 'to': "orm['taggit.Tag']"})
+        }
+    }
+
+    complete_apps = ['taggit']
@@ -0,0 +1,207 @@
+"""
+Streaming import and export of tag assignments.
+
+The rows are ``(model, object_id, tags)`` tuples, where ``model`` is an
+``"app_label.model"`` label and ``tags`` is either a tag string, as parsed by
+``parse_tags()``, or a list of tag names. Files hold one row per line, either
+as a JSON array (JSONL) or as CSV.
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import json
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import router
+from django.utils import six
+
+from taggit.managers import TaggableManager
+from taggit.models import GenericTaggedItemBase, atomic, get_through_models
+from taggit.utils import parse_tags_many, edit_string_for_names
+
+
+def read_rows(stream, format='jsonl'):
+    """
+    Reads rows from ``stream``, a file opened in binary mode, yielding
+    ``(offset, row)`` pairs where ``offset`` is the position right after the
+    row. Reading can be resumed by seeking to any of those offsets.
+    """
+    offset = stream.tell()
+    for line in iter(stream.readline, b''):
+        offset += len(line)
+        if not line.strip():
+            continue
+        if format == 'csv':
+            if six.PY3:
+                row = next(csv.reader([line.decode('utf-8')]))
+            else:
+                row = [c.decode('utf-8') for c in next(csv.reader([line]))]
+        else:
+            row = json.loads(line.decode('utf-8'))
+        if len(row) != 3:
+            raise ValueError("Expected (model, object_id, tags) at offset %d, "
+                             "got %r." % (offset - len(line), row))
+        yield offset, row
+
+
+class TagImporter(object):
+    """
+    Tags objects from batches of rows. The tags of a batch are created in
+    bulk and the links of every model are inserted in one transaction.
+
+    Rows of objects which don't exist, or whose id isn't valid, are skipped.
+    With ``dry_run`` the rows are only checked and counted.
+    """
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.imported = 0
+        self.skipped = 0
+        self._managers = {}
+
+    def get_manager(self, label):
+        """
+        Returns the tag manager of the model with the ``"app_label.model"``
+        ``label``, looking it up only once.
+        """
+        try:
+            return self._managers[label]
+        except KeyError:
+            pass
+        try:
+            app_label, model_name = label.split('.')
+            model = ContentType.objects.get_by_natural_key(
+                app_label, model_name.lower()).model_class()
+        except (ValueError, ContentType.DoesNotExist):
+            model = None
+        if model is None:
+            raise ValueError("Unknown model %r." % label)
+        fields = [f for f in model._meta.many_to_many
+                  if isinstance(f, TaggableManager)]
+        if len(fields) != 1:
+            raise ValueError("%s has %d tag fields, expected exactly one." % (
+                label, len(fields)))
+        manager = self._managers[label] = getattr(model, fields[0].name)
+        return manager
+
+    def import_rows(self, rows):
+        """
+        Imports ``rows``, a list of ``(model, object_id, tags)`` rows.
+        """
+        tag_lists = parse_tags_many(
+            tags if isinstance(tags, six.string_types) else ''
+            for model, object_id, tags in rows
+        )
+        groups = {}
+        for (label, object_id, tags), parsed in zip(rows, tag_lists):
+            if not isinstance(tags, six.string_types):
+                parsed = tags
+            manager = self.get_manager(label)
+            try:
+                pk = manager.model._meta.pk.to_python(object_id)
+            except (ValidationError, UnicodeEncodeError):
+                # Django 1.4 formats the error message of non-ASCII values
+                # with str().
+                pk = None
+            if pk is None:
+                self.skipped += 1
+                continue
+            groups.setdefault(label, []).append((pk, parsed))
+
+        for label, group in groups.items():
+            manager = self.get_manager(label)
+            model = manager.model
+            using = router.db_for_write(manager.through)
+            existing = set()
+            pks = list(set(pk for pk, tags in group))
+            for i in range(0, len(pks), 500):
+                existing.update(model._base_manager.using(using).filter(
+                    pk__in=pks[i:i + 500]).values_list('pk', flat=True))
+            tags_by_obj = [(model(pk=pk), tags) for pk, tags in group
+                           if pk in existing]
+            self.skipped += len(group) - len(tags_by_obj)
+            self.imported += len(tags_by_obj)
+            if self.dry_run:
+                continue
+            with atomic(using=using):
+                manager.add_to_each(tags_by_obj)
+
+
+def export_tags(through_models=None, batch_size=1000):
+    """
+    Yields a ``(model, object_id, tag names)`` row for every tagged object,
+    ordered by model and primary key.
+
+    The objects are paged by their primary key (keyset pagination), fetching
+    the tags of ``batch_size`` objects per query, so memory stays bounded
+    whatever the size of the through tables.
+    """
+    if through_models is None:
+        through_models = get_through_models()
+    for through in through_models:
+        if issubclass(through, GenericTaggedItemBase):
+            content_types = through.objects.values_list(
+                'content_type', flat=True).distinct().order_by('content_type')
+            for ct in list(content_types):
+                for row in _export_objects(
+                        through.objects.filter(content_type=ct), 'object_id',
+                        ContentType.objects.get_for_id(ct), batch_size):
+                    yield row
+        else:
+            model = through._meta.get_field('content_object').rel.to
+            for row in _export_objects(
+                    through.objects.all(), 'content_object',
+                    ContentType.objects.get_for_model(model), batch_size):
+                yield row
+
+
+def _export_objects(qs, field, content_type, batch_size):
+    label = '%s.%s' % (content_type.app_label, content_type.model)
+    # Ordering by a foreign key would use the ordering of the related model.
+    order = field if field == 'object_id' else '%s__pk' % field
+    last = None
+    while True:
+        page = qs
+        if last is not None:
+            page = page.filter(**{'%s__gt' % field: last})
+        ids = list(page.values_list(field, flat=True).distinct().order_by(
+            order)[:batch_size])
+        if not ids:
+            return
+        rows = qs.filter(**{'%s__in' % field: ids}).values_list(
+            field, 'tag__name').order_by(order, 'tag__name').iterator()
+        current, names = None, []
+        for object_id, name in rows:
+            if object_id != current:
+                if names:
+                    yield label, current, names
+                current, names = object_id, []
+            names.append(name)
+        if names:
+            yield label, current, names
+        last = ids[-1]
+
+
+def write_rows(stream, rows, format='jsonl'):
+    """
+    Writes ``(model, object_id, tag names)`` rows to ``stream``, a file
+    opened in binary mode, in the format read by ``read_rows()``. Returns the
+    number of rows written.
+    """
+    count = 0
+    for label, object_id, names in rows:
+        if format == 'csv':
+            buf = io.StringIO() if six.PY3 else io.BytesIO()
+            cells = [label, object_id, edit_string_for_names(names)]
+            if not six.PY3:
+                cells = [six.text_type(c).encode('utf-8') for c in cells]
+            csv.writer(buf, lineterminator='\n').writerow(cells)
+            line = buf.getvalue()
+            if six.PY3:
+                line = line.encode('utf-8')
+        else:
+            line = json.dumps([label, object_id, names]).encode('utf-8') + b'\n'
+        stream.write(line)
+        count += 1
+    return count
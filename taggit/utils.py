@@ -2,7 +2,6 @@ from __future__ import unicode_literals
 
 from django.utils.encoding import force_text
 from django.utils.functional import wraps
-from django.utils import six
 
 
 def parse_tags(tagstring):
@@ -30,43 +29,35 @@ def parse_tags(tagstring):
         return words
 
     words = []
-    buffer = []
     # Defer splitting of non-quoted sections until we know if there are
     # any unquoted commas.
     to_be_split = []
     saw_loose_comma = False
-    open_quote = False
-    i = iter(tagstring)
-    try:
-        while True:
-            c = six.next(i)
-            if c == '"':
-                if buffer:
-                    to_be_split.append(''.join(buffer))
-                    buffer = []
-                # Find the matching quote
-                open_quote = True
-                c = six.next(i)
-                while c != '"':
-                    buffer.append(c)
-                    c = six.next(i)
-                if buffer:
-                    word = ''.join(buffer).strip()
-                    if word:
-                        words.append(word)
-                    buffer = []
-                open_quote = False
-            else:
-                if not saw_loose_comma and c == ',':
-                    saw_loose_comma = True
-                buffer.append(c)
-    except StopIteration:
-        # If we were parsing an open quote which was never closed treat
-        # the buffer as unquoted.
-        if buffer:
-            if open_quote and ',' in buffer:
-                saw_loose_comma = True
-            to_be_split.append(''.join(buffer))
+    pos = 0
+    while True:
+        start = tagstring.find('"', pos)
+        if start == -1:
+            chunk = tagstring[pos:]
+        else:
+            chunk = tagstring[pos:start]
+        if chunk:
+            to_be_split.append(chunk)
+            saw_loose_comma = saw_loose_comma or ',' in chunk
+        if start == -1:
+            break
+        # Find the matching quote
+        end = tagstring.find('"', start + 1)
+        if end == -1:
+            # A quote which is never closed is treated as unquoted.
+            chunk = tagstring[start + 1:]
+            if chunk:
+                to_be_split.append(chunk)
+                saw_loose_comma = saw_loose_comma or ',' in chunk
+            break
+        word = tagstring[start + 1:end].strip()
+        if word:
+            words.append(word)
+        pos = end + 1
     if to_be_split:
         if saw_loose_comma:
             delimiter = ','
@@ -79,6 +70,25 @@ def parse_tags(tagstring):
     return words
 
 
+def parse_tags_many(tagstrings, cache_size=10000):
+    """
+    Parses each string of ``tagstrings`` like ``parse_tags()``, yielding the
+    lists of tag names one at a time.
+
+    The results of up to ``cache_size`` distinct strings are remembered, so
+    strings which repeat are only parsed once.
+    """
+    cache = {}
+    for tagstring in tagstrings:
+        try:
+            words = cache[tagstring]
+        except KeyError:
+            words = parse_tags(tagstring)
+            if len(cache) < cache_size:
+                cache[tagstring] = words
+        yield list(words)
+
+
 def split_strip(string, delimiter=','):
     """
     Splits ``string`` on ``delimiter``, stripping each resulting string
@@ -110,14 +120,34 @@ def edit_string_for_tags(tags):
     Ported from Jonathan Buchanan's `django-tagging
     <http://django-tagging.googlecode.com/>`_
     """
-    names = []
-    for tag in tags:
-        name = tag.name
+    return edit_string_for_names([tag.name for tag in tags])
+
+
+def edit_string_for_names(names):
+    """
+    Like ``edit_string_for_tags()``, but takes a list of tag names.
+    """
+    quoted = []
+    for name in names:
         if ',' in name or ' ' in name:
-            names.append('"%s"' % name)
+            quoted.append('"%s"' % name)
         else:
-            names.append(name)
-    return ', '.join(sorted(names))
+            quoted.append(name)
+    return ', '.join(sorted(quoted))
+
+
+def iter_chunks(iterable, size):
+    """
+    Yields lists of at most ``size`` consecutive items of ``iterable``.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def require_instance_manager(func):
@@ -1,21 +1,237 @@
 from __future__ import unicode_literals
 
+import calendar
+import datetime
+import hashlib
+import json
+
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.encoding import smart_bytes
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+    quote_etag)
+from django.views.generic.base import View
 from django.views.generic.list import ListView
 
-from taggit.models import TaggedItem, Tag
+from taggit.autocomplete import autocomplete
+from taggit.managers import _model_name
+from taggit.models import GenericTaggedItemBase, Tag, TaggedItem
+
+
+class TaggedObjectList(ListView):
+    """
+    Lists the objects of ``model`` (or ``queryset``) tagged with the tag whose
+    slug is passed as the ``slug`` URL keyword argument.
+
+    The objects are paged by key rather than by offset: a page holds the
+    ``paginate_by`` objects following the object id given in the ``after``
+    query parameter, in the order of the through table's
+    ``(tag, content_type, object_id)`` index, so deep pages are as cheap as
+    the first one. ``next_after`` in the context is the ``after`` value of the
+    next page, or ``None`` on the last page.
+
+    Responses carry an ``ETag`` computed from the tag and the field values of
+    the objects on the page and, if ``last_modified_field`` names a date field
+    of the model, a ``Last-Modified`` header with the newest value on the
+    page. Conditional requests matching them get a ``304 Not Modified``.
+    """
+    through = TaggedItem
+    tag_field = None
+    paginate_by = 20
+    after_kwarg = 'after'
+    last_modified_field = None
+    extra_context = None
+
+    def get_queryset(self):
+        if callable(self.queryset):
+            self.queryset = self.queryset()
+        return super(TaggedObjectList, self).get_queryset()
+
+    def get_through(self):
+        """
+        Returns the through model of ``tag_field``, the name of the model's
+        ``TaggableManager``, or ``through`` if it isn't set.
+        """
+        if self.tag_field is None:
+            return self.through
+        model = self.get_queryset().model
+        return model._meta.get_field(self.tag_field).through
+
+    def get_tag(self, through):
+        return get_object_or_404(through.tag_model(), slug=self.kwargs['slug'])
+
+    def get_after(self, queryset):
+        after = self.request.GET.get(self.after_kwarg)
+        if not after:
+            return None
+        try:
+            return queryset.model._meta.pk.to_python(after)
+        except ValidationError:
+            raise Http404("Invalid value for %r." % self.after_kwarg)
+
+    def get_page(self, queryset, through, tag, after):
+        """
+        Returns the list of objects after the id ``after`` and a flag telling
+        whether there are more.
+        """
+        page_size = self.get_paginate_by(queryset)
+        if not page_size:
+            raise ImproperlyConfigured("%s requires paginate_by." %
+                self.__class__.__name__)
+        if issubclass(through, GenericTaggedItemBase):
+            field = 'object_id'
+            items = through.objects.filter(tag=tag,
+                content_type=ContentType.objects.get_for_model(queryset.model))
+        else:
+            field = 'content_object'
+            items = through.objects.filter(tag=tag)
+        order = field if field == 'object_id' else '%s__pk' % field
+        if after is not None:
+            items = items.filter(**{'%s__gt' % order: after})
+        if queryset.query.where:
+            # Only restrict the keys when the queryset actually filters, to
+            # keep the plain case an index range scan.
+            items = items.filter(**{'%s__in' % field: queryset.values('pk')})
+        ids = list(items.order_by(order).values_list(field, flat=True)
+            [:page_size + 1])
+        has_next = len(ids) > page_size
+        ids = ids[:page_size]
+        objects = queryset.in_bulk(ids)
+        return [objects[pk] for pk in ids if pk in objects], has_next
+
+    def get_etag(self, tag, object_list):
+        """
+        Returns a hash of the tag and of the loaded field values of the
+        objects, so that editing an object on the page changes it. Override
+        it if the page shows related objects too.
+        """
+        etag = hashlib.md5(smart_bytes('%s:%s' % (tag.pk, tag.slug)))
+        for obj in object_list:
+            # Deferred fields are left out rather than loaded one by one.
+            values = [(f.attname, obj.__dict__[f.attname])
+                      for f in obj._meta.fields if f.attname in obj.__dict__]
+            etag.update(smart_bytes(':%r' % (values,)))
+        return etag.hexdigest()
+
+    def get_last_modified(self, object_list):
+        if self.last_modified_field is None or not object_list:
+            return None
+        return max(getattr(obj, self.last_modified_field)
+                   for obj in object_list)
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        through = self.get_through()
+        self.tag = self.get_tag(through)
+        after = self.get_after(queryset)
+        self.object_list, has_next = self.get_page(queryset, through, self.tag,
+                                                   after)
+        self.next_after = self.object_list[-1].pk if has_next else None
+
+        etag = quote_etag(self.get_etag(self.tag, self.object_list))
+        last_modified = self.get_last_modified(self.object_list)
+        if last_modified is not None:
+            last_modified = http_date(_timestamp(last_modified))
+        if self._not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            context = self.get_context_data(object_list=self.object_list,
+                                            queryset=queryset, after=after)
+            response = self.render_to_response(context)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = last_modified
+        return response
+
+    def _not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return '*' in etags or etag.strip('"') in etags
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return (if_modified_since is not None and last_modified is not None
+                and parse_http_date_safe(last_modified) <= if_modified_since)
+
+    def get_context_data(self, **kwargs):
+        # The objects are already paged, so ``ListView``'s pagination is
+        # bypassed.
+        object_list = kwargs.pop('object_list')
+        queryset = kwargs.pop('queryset')
+        context = {
+            'tag': self.tag,
+            'object_list': object_list,
+            'next_after': self.next_after,
+            'is_paginated': (kwargs.get('after') is not None or
+                             self.next_after is not None),
+            'view': self,
+        }
+        context_object_name = self.get_context_object_name(queryset)
+        if context_object_name is not None:
+            context[context_object_name] = object_list
+        if self.extra_context:
+            context.update(self.extra_context)
+        context.update(kwargs)
+        return context
+
+    def get_template_names(self):
+        if self.template_name is not None:
+            return [self.template_name]
+        model = self.get_queryset().model
+        return ['%s/%s%s.html' % (model._meta.app_label, _model_name(model),
+                                  self.template_name_suffix)]
+
+
+def _timestamp(value):
+    if not isinstance(value, datetime.datetime):
+        # The value of a DateField, taken as midnight UTC.
+        return calendar.timegm(value.timetuple())
+    if timezone.is_naive(value):
+        # Naive datetimes are in the current time zone (USE_TZ = False).
+        tz = timezone.get_default_timezone()
+        if hasattr(tz, 'localize'):  # pytz
+            value = tz.localize(value, is_dst=False)
+        else:
+            value = value.replace(tzinfo=tz)
+    return calendar.timegm(value.utctimetuple())
 
 
 def tagged_object_list(request, slug, queryset, **kwargs):
-    if callable(queryset):
-        queryset = queryset()
-    tag = get_object_or_404(Tag, slug=slug)
-    qs = queryset.filter(pk__in=TaggedItem.objects.filter(
-        tag=tag, content_type=ContentType.objects.get_for_model(queryset.model)
-    ).values_list("object_id", flat=True))
-    if "extra_context" not in kwargs:
-        kwargs["extra_context"] = {}
-    kwargs["extra_context"]["tag"] = tag
-    return ListView.as_view(request, qs, **kwargs)
+    """
+    Function based wrapper around ``TaggedObjectList``, ``kwargs`` are set as
+    attributes of the view.
+    """
+    return TaggedObjectList.as_view(queryset=queryset, **kwargs)(request,
+                                                                  slug=slug)
+
+
+class TagAutocomplete(View):
+    """
+    Returns a JSON list of the tags whose name starts with the ``q`` query
+    parameter, most used first, as ``{"name": ..., "slug": ..., "count": ...}``
+    objects. ``count`` is ``null`` if the tag model has no counts.
+
+    The ``limit`` query parameter can lower the number of tags from
+    ``limit``, but not raise it.
+    """
+    tag_model = Tag
+    limit = 10
+
+    def get_limit(self):
+        try:
+            return min(int(self.request.GET.get('limit', self.limit)), self.limit)
+        except ValueError:
+            return self.limit
 
+    def get(self, request, *args, **kwargs):
+        tags = autocomplete(self.tag_model, request.GET.get('q', '').strip(),
+                            self.get_limit())
+        data = [
+            {'name': tag.name, 'slug': tag.slug,
+             'count': getattr(tag, 'num_times', None)}
+            for tag in tags
+        ]
+        return HttpResponse(json.dumps(data), content_type='application/json')
@@ -0,0 +1,102 @@
+# * encoding: utf-8
+"""
+Compares the speed of ``parse_tags()`` with the character by character
+parser it replaced.
+
+Run with ``python -m tests.benchmark_parse_tags`` from the repository root.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import timeit
+
+from django.utils.encoding import force_text
+from django.utils import six
+
+from taggit.utils import parse_tags, parse_tags_many, split_strip
+
+
+def old_parse_tags(tagstring):
+    if not tagstring:
+        return []
+
+    tagstring = force_text(tagstring)
+
+    if ',' not in tagstring and '"' not in tagstring:
+        words = list(set(split_strip(tagstring, ' ')))
+        words.sort()
+        return words
+
+    words = []
+    buffer = []
+    to_be_split = []
+    saw_loose_comma = False
+    open_quote = False
+    i = iter(tagstring)
+    try:
+        while True:
+            c = six.next(i)
+            if c == '"':
+                if buffer:
+                    to_be_split.append(''.join(buffer))
+                    buffer = []
+                open_quote = True
+                c = six.next(i)
+                while c != '"':
+                    buffer.append(c)
+                    c = six.next(i)
+                if buffer:
+                    word = ''.join(buffer).strip()
+                    if word:
+                        words.append(word)
+                    buffer = []
+                open_quote = False
+            else:
+                if not saw_loose_comma and c == ',':
+                    saw_loose_comma = True
+                buffer.append(c)
+    except StopIteration:
+        if buffer:
+            if open_quote and ',' in buffer:
+                saw_loose_comma = True
+            to_be_split.append(''.join(buffer))
+    if to_be_split:
+        if saw_loose_comma:
+            delimiter = ','
+        else:
+            delimiter = ' '
+        for chunk in to_be_split:
+            words.extend(split_strip(chunk, delimiter))
+    words = list(set(words))
+    words.sort()
+    return words
+
+
+def random_tagstring(rnd, length=40):
+    return ''.join(rnd.choice('ab ,"') for _ in range(rnd.randint(0, length)))
+
+
+SAMPLES = [
+    'apple, banana, "cherry, red", date',
+    'green juicy "small and sour" apple',
+    '"unclosed, quote with many words',
+    'one two three four five six seven eight',
+]
+
+
+def main(number=20000):
+    rnd = random.Random(0)
+    strings = SAMPLES + [random_tagstring(rnd, 80) for _ in range(16)]
+    for func in (old_parse_tags, parse_tags):
+        seconds = timeit.timeit(
+            lambda: [func(s) for s in strings], number=number // len(strings))
+        print("%-16s %.3fs" % (func.__name__, seconds))
+    seconds = timeit.timeit(
+        lambda: list(parse_tags_many(strings * 10)),
+        number=number // len(strings) // 10)
+    print("%-16s %.3fs" % ('parse_tags_many', seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -146,6 +146,24 @@ class OfficialHousePet(OfficialPet):
     trained = models.BooleanField(default=False)
 
 
+# Test a custom tag model with a usage count
+
+class CountedTag(TagBase):
+    usage_count = models.IntegerField(default=0)
+
+class CountedThroughModel(GenericTaggedItemBase):
+    tag = models.ForeignKey(CountedTag, related_name="tagged_items")
+
+@python_2_unicode_compatible
+class CountedFood(models.Model):
+    name = models.CharField(max_length=50)
+
+    tags = TaggableManager(through=CountedThroughModel)
+
+    def __str__(self):
+        return self.name
+
+
 class Media(models.Model):
     tags = TaggableManager()
 
@@ -192,3 +210,10 @@ class CustomManager(models.Model):
             pass
 
     tags = TaggableManager(manager=Foo)
+
+
+class Event(models.Model):
+    name = models.CharField(max_length=50)
+    day = models.DateField()
+
+    tags = TaggableManager()